@@ -1,8 +1,8 @@
 import logging
-import json
+from threading import Lock
 
-from flask import Flask, request, send_from_directory
-import redis
+from flask import Flask, request, send_from_directory, abort
+from telegram import Update
 from environs import Env
 
 import fb_menu_keyboard
@@ -10,11 +10,24 @@ import fb_help_message
 import fb_cart_keyboard
 from fb_add_to_cart_message import send_add_to_cart_message
 from fb_remove_from_cart_message import send_remove_from_cart_message
+from fb_cart_changes_message import send_cart_changes
 from moltin_token import get_token
+import catalog
+import cart_debounce
 import moltin
+import fb_messenger
+import profiling
+import redis_keys
+import user_lock
+import webhook_worker
+import tg_pizza_bot
 
 app = Flask(__name__, static_url_path='/static')
 _database = None
+_telegram_updater = None
+_telegram_updater_lock = Lock()
+
+UNAVAILABLE_MESSAGE = 'Магазин временно недоступен, попробуйте, пожалуйста, через пару минут'
 
 env = Env()
 
@@ -33,18 +46,12 @@ def handle_menu(sender_id, message, db, moltin_token):
     user = f'fb_{sender_id}'
 
     if 'add_to_cart' in message:
-        menu = db.get('menu')
-        if not menu:
-            menu = moltin.get_products_list(moltin_token)
-            db.set('menu', json.dumps(menu))
-        else:
-            menu = json.loads(db.get('menu'))
         __, product_id = message.split(',')
 
-        send_add_to_cart_message(sender_id, product_id, moltin_token, user, menu)
+        send_add_to_cart_message(sender_id, product_id, moltin_token, user, db)
 
     if message == 'cart':
-        fb_cart_keyboard.get_cart_keyboard(sender_id, moltin_token)
+        fb_cart_keyboard.get_cart_keyboard(sender_id, moltin_token, db)
     return 'MENU'
 
 
@@ -52,28 +59,28 @@ def handle_cart(sender_id, message, db, moltin_token):
     user = f'fb_{sender_id}'
 
     if 'add_to_cart' in message:
-        menu = db.get('menu')
-        if not menu:
-            menu = moltin.get_products_list(moltin_token)
-            db.set('menu', json.dumps(menu))
-        else:
-            menu = json.loads(db.get('menu'))
         __, product_id = message.split(',')
 
-        send_add_to_cart_message(sender_id, product_id, moltin_token, user, menu)
+        send_add_to_cart_message(sender_id, product_id, moltin_token, user, db, with_cart=True)
 
-    if 'remove_from_cart' in message:
+    elif 'remove_from_cart' in message:
         __, item_id = message.split(',')
-        send_remove_from_cart_message(sender_id, message, moltin_token, user, item_id)
+        send_remove_from_cart_message(sender_id, message, moltin_token, user, item_id, db, with_cart=True)
 
-    fb_cart_keyboard.get_cart_keyboard(sender_id, moltin_token)
+    else:
+        fb_cart_keyboard.get_cart_keyboard(sender_id, moltin_token, db)
     return 'CART'
 
 
-def handle_users_reply(sender_id, message_text):
+@profiling.profiled_turn('messenger')
+def handle_users_reply(sender_id, message_text, lock_wait=None):
     db = get_database_connection()
-    moltin_token = get_token(db)
+    # Replies of one user are handled one by one across all workers
+    with user_lock.hold_lock(db, f'fb_{sender_id}', wait=lock_wait):
+        reply_to_user(db, sender_id, message_text)
+
 
+def reply_to_user(db, sender_id, message_text):
     states_functions = {
         'START': handle_start,
         'HELP': get_help,
@@ -81,8 +88,8 @@ def handle_users_reply(sender_id, message_text):
         'CART': handle_cart,
     }
 
-    user = f'fb_{sender_id}'
-    recorded_state = db.get(user)
+    state_key = redis_keys.get_fb_state_key(sender_id)
+    recorded_state = db.get(state_key)
     if not recorded_state or recorded_state.decode('utf-8') not in states_functions.keys():
         user_state = 'START'
     else:
@@ -98,14 +105,33 @@ def handle_users_reply(sender_id, message_text):
     if not user_state:
         user_state == 'HELP'
         
+    profiling.set_turn_state(user_state)
     state_handler = states_functions[user_state]
     try:
-        next_state = state_handler(sender_id, message_text, db, moltin_token)
-        db.set(user, next_state)
+        moltin_token = get_token(db)
+        with fb_messenger.batch():
+            next_state = state_handler(sender_id, message_text, db, moltin_token)
+        db.set(state_key, next_state, ex=redis_keys.get_session_ttl())
+    except moltin.MoltinUnavailable as err:
+        logging.warning('Reply of %s is not handled: %s', sender_id, err)
+        fb_messenger.send_message(sender_id, {'text': UNAVAILABLE_MESSAGE})
     except Exception as err:
         logging.exception(err)
 
 
+@app.before_first_request
+def start_background_jobs():
+    db = get_database_connection()
+    catalog.start_catalog_refresher(db, lambda: get_token(db))
+    cart_debounce.start_flusher(db, lambda: get_token(db), 'messenger', send_cart_changes)
+    if env('TELEGRAM_TOKEN', None):
+        cart_debounce.start_flusher(db, lambda: get_token(db), 'telegram', send_telegram_cart_changes)
+
+
+def send_telegram_cart_changes(db, token, user, cart_id, cart, changes):
+    tg_pizza_bot.send_cart_changes(get_telegram_updater().bot, db, token, user, cart_id, cart, changes)
+
+
 @app.route('/', methods=['GET'])
 def verify():
     if request.args.get('hub.mode') == 'subscribe' and request.args.get('hub.challenge'):
@@ -118,30 +144,137 @@ def verify():
 
 @app.route('/', methods=['POST'])
 def webhook():
-    data = request.get_json()
+    data = request.get_json(silent=True)
 
-    if data['object'] != 'page':
+    if not data or data.get('object') != 'page':
         return "ok", 200
 
-    for entry in data['entry']:
-        for messaging_event in entry['messaging']:
-            if messaging_event.get('message'):
-                sender_id = messaging_event['sender']['id']
-                message = messaging_event['message']['text']
-                handle_users_reply(sender_id, message)
+    # Every turn sends its replies while it holds the lock of its user
+    for entry in data.get('entry', []):
+        for messaging_event in entry.get('messaging', []):
+            sender_id = messaging_event.get('sender', {}).get('id')
+            if not sender_id:
+                continue
+            message = messaging_event.get('message')
+            if message and message.get('text') and not message.get('is_echo'):
+                reply = message['text']
             elif messaging_event.get('postback'):
-                sender_id = messaging_event['sender']['id']
-                payload = messaging_event['postback']['payload']
-                handle_users_reply(sender_id, payload)
-                
+                reply = messaging_event['postback']['payload']
+            else:
+                continue
+            # Echoes, read receipts and other ignored events are not remembered
+            if is_duplicate_event(sender_id, messaging_event):
+                continue
+            try:
+                process_users_reply(sender_id, reply)
+            except user_lock.UserBusy as err:
+                # Facebook delivers the batch again, the events handled so far are skipped then
+                logging.warning('Events of %s are sent back: %s', sender_id, err)
+                forget_event(sender_id, messaging_event)
+                return "busy", 503
+
     return "ok", 200
 
 
+def get_event_id(sender_id, messaging_event):
+    message = messaging_event.get('message') or {}
+    if message.get('mid'):
+        return message['mid']
+    if messaging_event.get('timestamp'):
+        return f'{sender_id}:{messaging_event["timestamp"]}'
+    return None
+
+
+def forget_event(sender_id, messaging_event):
+    event_id = get_event_id(sender_id, messaging_event)
+    if event_id:
+        get_database_connection().delete(redis_keys.get_fb_event_key(event_id))
+
+
+def is_duplicate_event(sender_id, messaging_event):
+    event_id = get_event_id(sender_id, messaging_event)
+    if not event_id:
+        return False
+
+    db = get_database_connection()
+    dedup_ttl = env.int('WEBHOOK_DEDUP_TTL', 10 * 60)
+    if db.set(redis_keys.get_fb_event_key(event_id), 1, nx=True, ex=dedup_ttl):
+        return False
+
+    # Facebook delivers the event again when we answered too slowly
+    profiling.increment('webhook_duplicates_total', {'channel': 'messenger'})
+    db.incr(redis_keys.DUPLICATE_EVENTS_KEY)
+    return True
+
+
+def process_users_reply(sender_id, message):
+    if env.bool('ASYNC_WEBHOOK', False):
+        webhook_worker.enqueue_event(get_database_connection(), sender_id, message)
+    else:
+        # Facebook gives up after 20 seconds and gunicorn kills the worker after 30,
+        # a busy user is sent back before either happens
+        handle_users_reply(sender_id, message, lock_wait=env.float('WEBHOOK_LOCK_WAIT', 3))
+
+
+@app.route('/telegram/<token>', methods=['POST'])
+def telegram_webhook(token):
+    telegram_token = env('TELEGRAM_TOKEN', None)
+    if not telegram_token or token != telegram_token:
+        abort(404)
+
+    update_content = request.get_json(force=True)
+    if env.bool('ASYNC_WEBHOOK', False):
+        chat_id = get_telegram_chat_id(update_content)
+        webhook_worker.enqueue_telegram_update(get_database_connection(), chat_id, update_content)
+    else:
+        handle_telegram_update(update_content)
+
+    return "ok", 200
+
+
+def get_telegram_chat_id(update_content):
+    update = Update.de_json(update_content, None)
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return None
+
+
+def handle_telegram_update(update_content):
+    updater = get_telegram_updater()
+    updater.dispatcher.process_update(Update.de_json(update_content, updater.bot))
+
+
+def handle_event(event):
+    # Events queued before the channel was recorded all come from Messenger
+    if event.get('channel') == 'telegram':
+        handle_telegram_update(event['update'])
+    else:
+        handle_users_reply(event['sender_id'], event['message'])
+
+
+@app.route('/metrics')
+def metrics():
+    return profiling.render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
 @app.route('/img/')
 def send_img(path):
     return send_from_directory('img', path)
 
 
+def get_telegram_updater():
+    global _telegram_updater
+    # Requests of one gunicorn worker run in threads, each would build its own updater
+    with _telegram_updater_lock:
+        if _telegram_updater is None:
+            updater = tg_pizza_bot.create_updater(env('TELEGRAM_TOKEN'))
+            updater.job_queue.start()
+            _telegram_updater = updater
+    return _telegram_updater
+
+
 def get_database_connection():
     global _database
     if _database is None:
@@ -149,9 +282,9 @@ def get_database_connection():
         database_host = env("DATABASE_HOST")
         database_port = env("DATABASE_PORT")
 
-        _database = redis.Redis(host=database_host,
-                                port=database_port,
-                                password=database_password)
+        _database = profiling.InstrumentedRedis(host=database_host,
+                                                port=database_port,
+                                                password=database_password)
     return _database
 
 
@@ -0,0 +1,156 @@
+import logging
+import json
+import time
+from threading import Thread
+
+from environs import Env
+
+import moltin
+import cart_mirror
+import redis_keys
+import user_lock
+
+env = Env()
+
+# Changes wait this long for a process that applies them
+FLUSH_TIMEOUT_MS = 10 * 60 * 1000
+SWEEP_INTERVAL = 0.1
+
+
+def get_window():
+    return env.int('CART_DEBOUNCE_MS', 0)
+
+
+def is_enabled():
+    return get_window() > 0
+
+
+def add_product(db, token, channel, user, cart_id, product_id, quantity, reply=None, on_changed=None):
+    change = {'product_id': product_id, 'quantity': quantity, 'reply': reply or {}}
+    if not is_enabled():
+        cart = cart_mirror.add_product(db, token, cart_id, product_id, quantity)
+        if on_changed:
+            on_changed(cart, [change])
+        return
+    queue_change(db, channel, user, cart_id, change)
+
+
+def remove_item(db, token, channel, user, cart_id, item_id, reply=None, on_changed=None):
+    change = {'item_id': item_id, 'reply': reply or {}}
+    if not is_enabled():
+        cart = cart_mirror.remove_item(db, token, cart_id, item_id)
+        if on_changed:
+            on_changed(cart, [change])
+        return
+    queue_change(db, channel, user, cart_id, change)
+
+
+def get_flush_member(user, cart_id):
+    return json.dumps([user, cart_id])
+
+
+def queue_change(db, channel, user, cart_id, change):
+    window = get_window()
+    changes_key = redis_keys.get_cart_changes_key(cart_id)
+    due_at = int(time.time() * 1000) + window
+
+    # The first change of the window sets when all of them are applied
+    pipe = db.pipeline()
+    pipe.rpush(changes_key, json.dumps(change))
+    pipe.pexpire(changes_key, window + FLUSH_TIMEOUT_MS)
+    pipe.zadd(redis_keys.get_cart_flush_due_key(channel), {get_flush_member(user, cart_id): due_at}, nx=True)
+    pipe.execute()
+
+
+def flush_due_changes(db, get_token, channel, send_changes):
+    due_key = redis_keys.get_cart_flush_due_key(channel)
+    now = int(time.time() * 1000)
+    for member in db.zrangebyscore(due_key, 0, now, start=0, num=100):
+        # Every process sweeps, the one that removes the member applies the changes
+        if not db.zrem(due_key, member):
+            continue
+        user, cart_id = json.loads(member)
+        try:
+            flush_changes(db, get_token(), user, cart_id, send_changes)
+        except user_lock.UserBusy as err:
+            logging.warning('Changes of cart %s are put off: %s', cart_id, err)
+            db.zadd(due_key, {member: int(time.time() * 1000) + get_window()})
+        except Exception as err:
+            logging.exception(err)
+
+
+def flush_changes(db, token, user, cart_id, send_changes):
+    # Under the lock of the user the replies of the turns and of the changes never mix
+    with user_lock.hold_lock(db, user):
+        pipe = db.pipeline()
+        pipe.lrange(redis_keys.get_cart_changes_key(cart_id), 0, -1)
+        pipe.delete(redis_keys.get_cart_changes_key(cart_id))
+        changes, __ = pipe.execute()
+        changes = [json.loads(change) for change in changes]
+        if not changes:
+            return
+        try:
+            cart = apply_changes(db, token, cart_id, changes)
+        except moltin.MoltinUnavailable as err:
+            # Some of the changes may have reached moltin, the copy of the cart is read again
+            logging.warning('Changes of cart %s are not applied: %s', cart_id, err)
+            db.delete(redis_keys.get_cart_key(cart_id))
+            cart = None
+        send_changes(db, token, user, cart_id, cart, changes)
+
+
+def flush_periodically(db, get_token, channel, send_changes):
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        try:
+            flush_due_changes(db, get_token, channel, send_changes)
+        except Exception as err:
+            logging.exception(err)
+
+
+def start_flusher(db, get_token, channel, send_changes):
+    if not is_enabled():
+        return
+    flusher = Thread(target=flush_periodically,
+                     args=(db, get_token, channel, send_changes),
+                     daemon=True)
+    flusher.start()
+
+
+def get_target_quantities(cart, changes):
+    products_by_items = {item['id']: item['product_id'] for item in cart['items']}
+    quantities = {item['product_id']: item['quantity'] for item in cart['items']}
+    for change in changes:
+        if 'item_id' in change:
+            product_id = products_by_items.get(change['item_id'])
+            if product_id:
+                quantities[product_id] = 0
+        else:
+            product_id = change['product_id']
+            quantities[product_id] = quantities.get(product_id, 0) + change['quantity']
+    return quantities
+
+
+def apply_changes(db, token, cart_id, changes):
+    cart = cart_mirror.get_cart(db, token, cart_id)
+    items = {item['product_id']: item for item in cart['items']}
+
+    is_changed = False
+    for product_id, quantity in get_target_quantities(cart, changes).items():
+        item = items.get(product_id)
+        current_quantity = item['quantity'] if item else 0
+        if quantity == current_quantity:
+            continue
+        if not item:
+            cart = moltin.add_product_to_cart(product_id, token, quantity, cart_id)
+        elif not quantity:
+            cart = moltin.remove_cart_item(token, cart_id, item['id'])
+        elif quantity > current_quantity:
+            cart = moltin.add_product_to_cart(product_id, token, quantity - current_quantity, cart_id)
+        else:
+            cart = moltin.update_cart_item_quantity(token, cart_id, item['id'], quantity)
+        is_changed = True
+
+    if is_changed:
+        cart = cart_mirror.save_cart(db, cart_id, cart)
+    return cart
@@ -0,0 +1,49 @@
+import time
+
+from environs import Env
+
+import moltin
+import redis_keys
+import serializer
+
+env = Env()
+
+
+def save_cart(db, cart_id, cart):
+    mirror = {**cart, 'synced_at': time.time()}
+    db.set(redis_keys.get_cart_key(cart_id), serializer.dumps(mirror, 'cart'), ex=env.int('CART_MIRROR_TTL', 24 * 60 * 60))
+    return cart
+
+
+def sync_cart(db, token, cart_id):
+    return save_cart(db, cart_id, moltin.get_cart_items(token, cart_id))
+
+
+def get_cart(db, token, cart_id):
+    cart = db.get(redis_keys.get_cart_key(cart_id))
+    if cart:
+        cart = serializer.loads(cart, 'cart')
+        synced_at = cart.pop('synced_at')
+        if time.time() - synced_at <= env.int('CART_MIRROR_STALENESS', 5 * 60):
+            return cart
+    try:
+        return sync_cart(db, token, cart_id)
+    except moltin.MoltinUnavailable:
+        if not cart:
+            raise
+        return cart
+
+
+def add_product(db, token, cart_id, product_id, quantity):
+    cart = moltin.add_product_to_cart(product_id, token, quantity, cart_id)
+    return save_cart(db, cart_id, cart)
+
+
+def remove_item(db, token, cart_id, item_id):
+    cart = moltin.remove_cart_item(token, cart_id, item_id)
+    return save_cart(db, cart_id, cart)
+
+
+def clear_cart(db, token, cart_id):
+    moltin.remove_all_cart_items(token, cart_id)
+    db.delete(redis_keys.get_cart_key(cart_id))
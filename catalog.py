@@ -0,0 +1,204 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+
+from environs import Env
+
+import moltin
+import image_cache
+import closest_pizzeria
+import redis_keys
+import serializer
+
+env = Env()
+
+_catalog = None
+_catalog_version = None
+
+
+def get_products_by_id(products):
+    return {product['id']: product for product in products}
+
+
+def build_catalog(token, db, timings=None):
+    timings = {} if timings is None else timings
+    with ThreadPoolExecutor(max_workers=env.int('CATALOG_WORKERS', 8)) as executor:
+        started_at = time.monotonic()
+        products_future = executor.submit(get_products_by_id, moltin.iter_products(token))
+        categories_future = executor.submit(moltin.get_all_categories, token)
+        pizzerias_future = executor.submit(moltin.get_all_pizzerias, token)
+        products_by_id = products_future.result()
+        categories = categories_future.result()
+        pizzerias = pizzerias_future.result()
+        timings['products, categories and pizzerias'] = time.monotonic() - started_at
+
+        started_at = time.monotonic()
+        category_futures = {
+            category: executor.submit(get_products_by_id, moltin.iter_products(token, category_id))
+            for category, category_id in categories.items()
+        }
+        products_by_categories = {}
+        for category, category_future in category_futures.items():
+            category_products_by_id = category_future.result()
+            for product_id, product in category_products_by_id.items():
+                products_by_id.setdefault(product_id, product)
+            products_by_categories[category] = list(category_products_by_id)
+        timings['products by categories'] = time.monotonic() - started_at
+
+    started_at = time.monotonic()
+    products = list(products_by_id.values())
+    image_urls = image_cache.get_image_urls(token, db, [product['image_id'] for product in products])
+    for product in products:
+        product['image_url'] = image_urls[product['image_id']]
+    timings['image urls'] = time.monotonic() - started_at
+
+    return {
+        'products': products,
+        'categories': categories,
+        'products_by_categories': products_by_categories,
+        'pizzerias': pizzerias,
+    }
+
+
+def publish_catalog(db, catalog):
+    version = str(int(time.time() * 1000))
+    previous_version = db.get(redis_keys.CATALOG_VERSION_KEY)
+
+    pipe = db.pipeline()
+    pipe.set(redis_keys.get_catalog_key(version), serializer.dumps(catalog, 'catalog'))
+    for renderer in get_renderers():
+        # A renderer renders before it queues its writes, so a failed one leaves nothing behind
+        try:
+            renderer(pipe, catalog, version)
+        except Exception:
+            logging.exception('%s is not published with catalog %s', renderer.__name__, version)
+    pipe.set(redis_keys.CATALOG_VERSION_KEY, version)
+    if previous_version:
+        previous_key = redis_keys.get_catalog_key(previous_version.decode('utf-8'))
+        pipe.expire(previous_key, env.int('CATALOG_PREVIOUS_TTL', 60 * 60))
+    pipe.execute()
+
+    return version
+
+
+def get_renderers():
+    # Imported here, fb_menu_keyboard reads the catalog from this module
+    import fb_menu_keyboard
+
+    return [fb_menu_keyboard.save_menu_messages]
+
+
+def set_local_catalog(catalog, version):
+    global _catalog, _catalog_version
+    catalog['version'] = version
+    catalog['products_by_id'] = get_products_by_id(catalog['products'])
+    catalog['pizzerias_index'] = closest_pizzeria.build_pizzerias_index(catalog['pizzerias'])
+    _catalog, _catalog_version = catalog, version
+    return catalog
+
+
+def refresh_catalog(db, token, timings=None):
+    timings = {} if timings is None else timings
+    catalog = build_catalog(token, db, timings)
+
+    started_at = time.monotonic()
+    version = publish_catalog(db, catalog)
+    timings['publish'] = time.monotonic() - started_at
+
+    logging.info('Catalog %s is published: %s', version, timings)
+    return set_local_catalog(catalog, version)
+
+
+def load_published_catalog(db):
+    version = db.get(redis_keys.CATALOG_VERSION_KEY)
+    if version is None:
+        return None
+
+    version = version.decode('utf-8')
+    if version == _catalog_version:
+        return _catalog
+    catalog = db.get(redis_keys.get_catalog_key(version))
+    if catalog is None:
+        return None
+    return set_local_catalog(serializer.loads(catalog, 'catalog'), version)
+
+
+def build_missing_catalog(db, token):
+    # One process builds the missing snapshot, the others serve their stale copy or wait for it
+    if not db.set(redis_keys.CATALOG_REFRESH_LOCK_KEY, 1, nx=True, ex=get_refresh_interval()):
+        if _catalog is not None:
+            return _catalog
+        return wait_for_catalog(db, token)
+
+    try:
+        return refresh_catalog(db, token)
+    except moltin.MoltinUnavailable as err:
+        db.delete(redis_keys.CATALOG_REFRESH_LOCK_KEY)
+        if _catalog is None:
+            raise
+        logging.warning('Catalog %s is served while moltin is unavailable: %s', _catalog_version, err)
+        return _catalog
+    except Exception:
+        db.delete(redis_keys.CATALOG_REFRESH_LOCK_KEY)
+        raise
+
+
+def wait_for_catalog(db, token):
+    deadline = time.monotonic() + env.float('CATALOG_BUILD_TIMEOUT', 60)
+    while time.monotonic() < deadline:
+        time.sleep(0.1)
+        catalog = load_published_catalog(db)
+        if catalog is not None:
+            return catalog
+        if not db.exists(redis_keys.CATALOG_REFRESH_LOCK_KEY):
+            # The process that was building it has failed
+            return build_missing_catalog(db, token)
+    raise moltin.MoltinUnavailable('Catalog is not built in time by another process')
+
+
+def get_catalog(db, token):
+    catalog = load_published_catalog(db)
+    if catalog is None:
+        return build_missing_catalog(db, token)
+    return catalog
+
+
+def get_product(db, token, product_id):
+    return get_catalog(db, token)['products_by_id'][product_id]
+
+
+def get_pizzerias_index(db, token):
+    return get_catalog(db, token)['pizzerias_index']
+
+
+def get_category_products(catalog, category):
+    products_by_id = catalog.get('products_by_id')
+    if products_by_id is None:
+        products_by_id = get_products_by_id(catalog['products'])
+    return [products_by_id[product_id] for product_id in catalog['products_by_categories'][category]]
+
+
+def refresh_catalog_periodically(db, get_token, interval):
+    while True:
+        time.sleep(interval)
+        if not db.set(redis_keys.CATALOG_REFRESH_LOCK_KEY, 1, nx=True, ex=interval):
+            continue
+        try:
+            refresh_catalog(db, get_token())
+        except moltin.MoltinUnavailable as err:
+            logging.warning('Catalog %s is kept, moltin is unavailable: %s', _catalog_version, err)
+        except Exception as err:
+            logging.exception(err)
+
+
+def get_refresh_interval():
+    return env.int('CATALOG_REFRESH_INTERVAL', 10 * 60)
+
+
+def start_catalog_refresher(db, get_token):
+    interval = get_refresh_interval()
+    refresher = Thread(target=refresh_catalog_periodically,
+                       args=(db, get_token, interval),
+                       daemon=True)
+    refresher.start()
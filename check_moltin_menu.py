@@ -1,8 +1,10 @@
-import redis
-import json
+import logging
+
 from environs import Env
 
+import catalog
 import moltin
+import profiling
 from moltin_token import get_token
 
 _database = None
@@ -11,27 +13,6 @@ env = Env()
 env.read_env()
 
 
-def get_full_menu(token, db):
-    menu = moltin.get_products_list(moltin_token)
-    db.set('menu', json.dumps(menu))
-    return menu
-
-
-def get_categories(token, db):
-    categories = moltin.get_all_categories(token)
-    db.set('categories', json.dumps(categories))
-    return categories
-
-
-def get_products_by_categories(token, db, categories):
-    products_by_categories = {}
-    for category in categories:
-        products = moltin.get_products_by_category_id(token, categories[category])
-        products_by_categories[category] = products
-    
-    db.set('products_by_categories', json.dumps(products_by_categories))
-
-
 def get_database_connection():
     global _database
     if _database is None:
@@ -39,15 +20,24 @@ def get_database_connection():
         database_host = env("DATABASE_HOST")
         database_port = env("DATABASE_PORT")
 
-        _database = redis.Redis(host=database_host,
-                                port=database_port,
-                                password=database_password)
+        _database = profiling.InstrumentedRedis(host=database_host,
+                                                port=database_port,
+                                                password=database_password)
     return _database
 
 
 if __name__ == "__main__":
     db = get_database_connection()
-    moltin_token, moltin_token_time = get_token()
-    menu = get_full_menu(moltin_token, db)
-    categories = get_categories(moltin_token, db)
-    get_products_by_categories(moltin_token, db, categories)
\ No newline at end of file
+    timings = {}
+    try:
+        moltin_token = get_token(db)
+        menu_catalog = catalog.refresh_catalog(db, moltin_token, timings)
+    except moltin.MoltinUnavailable as err:
+        # Runs in the release phase: an outage of moltin must not block deploys,
+        # the bots build the menu themselves once moltin is back
+        logging.warning('Menu is not warmed up: %s', err)
+    else:
+        print(f'Catalog {menu_catalog["version"]}: {len(menu_catalog["products"])} products, '
+              f'{len(menu_catalog["categories"])} categories, {len(menu_catalog["pizzerias"])} pizzerias')
+        for phase, duration in timings.items():
+            print(f'{phase}: {duration:.2f} s')
@@ -0,0 +1,48 @@
+import logging
+import time
+from threading import Lock
+
+import profiling
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = Lock()
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Let one request through to probe whether the service is back
+                self.state = HALF_OPEN
+                return True
+        profiling.increment('circuit_breaker_rejections_total', {'dependency': self.name})
+        return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != CLOSED:
+                logging.warning('Circuit of %s is closed', self.name)
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    logging.warning('Circuit of %s is open after %s failures', self.name, self.failures)
+                    profiling.increment('circuit_breaker_opened_total', {'dependency': self.name})
+                self.state = OPEN
+                self.opened_at = time.monotonic()
@@ -1,15 +1,105 @@
+from math import radians, sin, cos, asin, pi
+
 from geopy import distance
 
+EARTH_RADIUS_KM = 6371.0088
+# Around one place, geodesic distances in different directions are shorter or
+# longer than the great-circle ones by less than 0.7% of each other, so every
+# pizzeria that can be the closest one by geodesic distance is within this
+# margin of the closest one on the sphere.
+CANDIDATES_MARGIN = 1.01
+
+
+def get_unit_vector(lat, lon):
+    lat, lon = radians(float(lat)), radians(float(lon))
+    return (cos(lat) * cos(lon), cos(lat) * sin(lon), sin(lat))
+
+
+def get_squared_chord(first_vector, second_vector):
+    return sum((first - second) ** 2 for first, second in zip(first_vector, second_vector))
+
+
+def get_sphere_distance(squared_chord):
+    return 2 * asin(min(squared_chord ** 0.5 / 2, 1)) * EARTH_RADIUS_KM
+
+
+def get_squared_chord_for_distance(sphere_distance):
+    angle = min(sphere_distance / EARTH_RADIUS_KM, pi)
+    return (2 * sin(angle / 2)) ** 2
+
+
+def build_kd_tree(points, depth=0):
+    if not points:
+        return None
+    axis = depth % 3
+    points.sort(key=lambda point: point[0][axis])
+    median = len(points) // 2
+    return (
+        points[median],
+        axis,
+        build_kd_tree(points[:median], depth + 1),
+        build_kd_tree(points[median + 1:], depth + 1),
+    )
+
+
+def find_nearest(node, target, best=None):
+    if node is None:
+        return best
+    (vector, pizzeria_number), axis, left, right = node
+    squared_chord = get_squared_chord(vector, target)
+    if best is None or squared_chord < best[0]:
+        best = (squared_chord, pizzeria_number)
 
-def get_closest_pizzeria(lon, lat, pizzerias):
-    for pizzeria in pizzerias:
+    axis_difference = target[axis] - vector[axis]
+    near, far = (left, right) if axis_difference < 0 else (right, left)
+    best = find_nearest(near, target, best)
+    if axis_difference ** 2 < best[0]:
+        best = find_nearest(far, target, best)
+    return best
+
+
+def find_within(node, target, max_squared_chord, found):
+    if node is None:
+        return found
+    (vector, pizzeria_number), axis, left, right = node
+    if get_squared_chord(vector, target) <= max_squared_chord:
+        found.append(pizzeria_number)
+
+    axis_difference = target[axis] - vector[axis]
+    if axis_difference <= 0 or axis_difference ** 2 <= max_squared_chord:
+        find_within(left, target, max_squared_chord, found)
+    if axis_difference >= 0 or axis_difference ** 2 <= max_squared_chord:
+        find_within(right, target, max_squared_chord, found)
+    return found
+
+
+def build_pizzerias_index(pizzerias):
+    points = [
+        (get_unit_vector(pizzeria['latitude'], pizzeria['longitude']), pizzeria_number)
+        for pizzeria_number, pizzeria in enumerate(pizzerias)
+    ]
+    return {'pizzerias': pizzerias, 'tree': build_kd_tree(points)}
+
+
+def get_closest_pizzeria(lon, lat, pizzerias_index):
+    pizzerias = pizzerias_index['pizzerias']
+    target = get_unit_vector(lat, lon)
+
+    nearest = find_nearest(pizzerias_index['tree'], target)
+    if nearest is None:
+        return None
+
+    nearest_squared_chord, __ = nearest
+    max_distance = get_sphere_distance(nearest_squared_chord) * CANDIDATES_MARGIN
+    candidates = find_within(pizzerias_index['tree'], target,
+                             get_squared_chord_for_distance(max_distance), [])
+
+    closest_pizzeria = None
+    for pizzeria_number in candidates:
+        pizzeria = pizzerias[pizzeria_number]
         pizzeria_coordinate = (pizzeria['latitude'], pizzeria['longitude'])
         pizzeria_distance = distance.distance(pizzeria_coordinate, (lat, lon)).km
-        pizzeria['distance'] = pizzeria_distance
+        if closest_pizzeria is None or pizzeria_distance < closest_pizzeria['distance']:
+            closest_pizzeria = {**pizzeria, 'distance': pizzeria_distance}
 
-    closest_pizzeria = min(pizzerias, key=get_distance)
     return closest_pizzeria
-
-
-def get_distance(pizzerias):
-    return pizzerias['distance']
\ No newline at end of file
@@ -1,27 +1,12 @@
-import requests
+from functools import partial
 
-from environs import Env
+import cart_debounce
+from fb_cart_changes_message import send_cart_changes
 
-import moltin
 
-env = Env()
-
-
-def send_add_to_cart_message(sender_id, product_id, token, user, menu):
+def send_add_to_cart_message(sender_id, product_id, token, user, db, with_cart=False):
     quantity = 1
-    moltin.add_product_to_cart(product_id, token, quantity, user)
-    product = next((product for product in menu if product['id'] == product_id))
-    params = {'access_token': env('PAGE_ACCESS_TOKEN')}
-    headers = {'Content-Type': 'application/json'}
-    text = f'Пицца {product["name"]} добавлена в корзину'
-    request_content = {
-        "recipient": {
-            "id": sender_id
-        },
-        "message": {
-            "text": text
-        }
-    }
-    url = 'https://graph.facebook.com/v2.6/me/messages'
-    response = requests.post(url, params=params, headers=headers, json=request_content)
-    response.raise_for_status()
\ No newline at end of file
+    reply = {'sender_id': sender_id, 'cart': with_cart}
+    on_changed = partial(send_cart_changes, db, token, user, user)
+
+    cart_debounce.add_product(db, token, 'messenger', user, user, product_id, quantity, reply, on_changed)
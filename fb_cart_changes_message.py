@@ -0,0 +1,34 @@
+import catalog
+import fb_cart_keyboard
+import fb_messenger
+
+CART_UNAVAILABLE_MESSAGE = 'Не получилось изменить корзину: магазин временно недоступен, попробуйте, пожалуйста, через пару минут'
+
+
+def get_cart_changes_text(changes, token, db):
+    product_ids = dict.fromkeys(change['product_id'] for change in changes if 'product_id' in change)
+    names = [catalog.get_product(db, token, product_id)['name'] for product_id in product_ids]
+    removed_count = sum('item_id' in change for change in changes)
+
+    lines = []
+    if len(names) == 1:
+        lines.append(f'Пицца {names[0]} добавлена в корзину')
+    elif names:
+        lines.append(f'Пиццы {", ".join(names)} добавлены в корзину')
+    if removed_count == 1:
+        lines.append('Убрана из корзины')
+    elif removed_count:
+        lines.append(f'Убрано из корзины: {removed_count}')
+    return '\n'.join(lines)
+
+
+def send_cart_changes(db, token, user, cart_id, cart, changes):
+    # One reply for all the taps of the window, whichever of them asked for the cart
+    sender_id = changes[-1]['reply']['sender_id']
+    with fb_messenger.batch():
+        if cart is None:
+            fb_messenger.send_message(sender_id, {'text': CART_UNAVAILABLE_MESSAGE})
+            return
+        fb_messenger.send_message(sender_id, {'text': get_cart_changes_text(changes, token, db)})
+        if any(change['reply'].get('cart') for change in changes):
+            fb_cart_keyboard.send_cart_keyboard(sender_id, cart)
@@ -1,38 +1,30 @@
-import requests
-import json
-
 from environs import Env
 
-import moltin
+import cart_mirror
+import fb_messenger
 
 env = Env()
 
 
-def get_cart_keyboard(sender_id, token):
+def get_cart_keyboard(sender_id, token, db):
     user = f'fb_{sender_id}'
-    cart = moltin.get_cart_items(token, user)
+    cart = cart_mirror.get_cart(db, token, user)
+    send_cart_keyboard(sender_id, cart)
+
 
+def send_cart_keyboard(sender_id, cart):
     elements = get_cart_keyboard_content(cart)
-    params = {'access_token': env('PAGE_ACCESS_TOKEN')}
-    headers = {'Content-Type': 'application/json'}
-    request_content = {
-            'recipient': {
-                'id': sender_id
-            },
-            'message': {
-                'attachment': {
-                    'type': 'template',
-                    'payload': {
-                        'template_type': 'generic',
-                        'image_aspect_ratio': 'square',
-                        'elements': elements
-                    }
+    template_message = {
+            'attachment': {
+                'type': 'template',
+                'payload': {
+                    'template_type': 'generic',
+                    'image_aspect_ratio': 'square',
+                    'elements': elements
                 }
             }
         }
-    url = 'https://graph.facebook.com/v2.6/me/messages'
-    response = requests.post(url, params=params, headers=headers, json=request_content)
-    response.raise_for_status()
+    fb_messenger.send_message(sender_id, template_message)
 
 
 def get_cart_keyboard_content(cart):
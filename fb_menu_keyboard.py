@@ -1,25 +1,63 @@
-import requests
 import json
 
 from environs import Env
 
-import moltin
-from check_moltin_menu import get_products_by_categories
+import catalog
+import fb_messenger
+import redis_keys
 
 env = Env()
 
+MAIN_MENU_PAGE = 'menu'
+
+_menu_messages = (None, {})
+
 
 def send_menu(sender_id, token, db, message='menu'):
-    user = f'fb_{sender_id}'
-
-    elements = get_menu_keyboard_content(token, message, db, user)
-    params = {'access_token': env('PAGE_ACCESS_TOKEN')}
-    headers = {'Content-Type': 'application/json'}
-    request_content = {
-            'recipient': {
-                'id': sender_id
-            },
-            'message': {
+    if message == '/start' or message == 'menu':
+        menu_page = MAIN_MENU_PAGE
+    else:
+        __, menu_page = message.split(',')
+
+    menu_messages = get_menu_messages(db, token)
+    fb_messenger.send_encoded_message(sender_id, menu_messages[menu_page])
+
+
+def get_menu_messages(db, token):
+    global _menu_messages
+    menu_catalog = catalog.get_catalog(db, token)
+    version, menu_messages = _menu_messages
+    if version == menu_catalog['version']:
+        return menu_messages
+
+    menu_messages = {
+        menu_page.decode('utf-8'): menu_message
+        for menu_page, menu_message
+        in db.hgetall(redis_keys.get_fb_menu_key(menu_catalog['version'])).items()
+    }
+    if not menu_messages:
+        pipe = db.pipeline()
+        menu_messages = save_menu_messages(pipe, menu_catalog, menu_catalog['version'])
+        pipe.execute()
+
+    _menu_messages = (menu_catalog['version'], menu_messages)
+    return menu_messages
+
+
+def save_menu_messages(pipe, menu_catalog, version):
+    menu_messages = render_menu_messages(menu_catalog)
+    menu_messages_key = redis_keys.get_fb_menu_key(version)
+    pipe.hset(menu_messages_key, mapping=menu_messages)
+    pipe.expire(menu_messages_key, env.int('FB_MENU_TTL', 24 * 60 * 60))
+    return menu_messages
+
+
+def render_menu_messages(menu_catalog):
+    menu_pages = [MAIN_MENU_PAGE] + list(menu_catalog['categories'])
+    menu_messages = {}
+    for menu_page in menu_pages:
+        elements = get_menu_keyboard_content(menu_catalog, menu_page)
+        template_message = {
                 'attachment': {
                     'type': 'template',
                     'payload': {
@@ -29,39 +67,23 @@ def send_menu(sender_id, token, db, message='menu'):
                     }
                 }
             }
-        }
-    url = 'https://graph.facebook.com/v2.6/me/messages'
-    response = requests.post(url, params=params, headers=headers, json=request_content)
-    response.raise_for_status()
+        menu_messages[menu_page] = json.dumps(template_message).encode('utf-8')
+    return menu_messages
     
 
-def get_menu_keyboard_content(token, message, db, user):
-    categories = db.get('categories')
-    if not categories:
-        categories = moltin.get_all_categories(token)
-        db.set('categories', json.dumps(categories))
-    else:
-        categories = json.loads(db.get('categories'))
-    
-    products_by_categories = db.get('products_by_categories')
-    if not products_by_categories:
-        products_by_categories = get_products_by_categories(token, db, categories)
-        db.set('product_by_categories', json.dumps(products_by_categories))
-    else:
-        products_by_categories = json.loads(db.get('products_by_categories'))
+def get_menu_keyboard_content(menu_catalog, menu_page):
+    categories = menu_catalog['categories']
 
     first_page_menu = get_first_page_menu()
 
-    if message == '/start' or message == 'menu':
-        products = products_by_categories['Главная']
-
-    elif 'start' in message:
-        __, category = message.split(',')
-        products = products_by_categories[category][:4]
+    if menu_page == MAIN_MENU_PAGE:
+        products = catalog.get_category_products(menu_catalog, 'Главная')
+    else:
+        products = catalog.get_category_products(menu_catalog, menu_page)[:4]
 
-    main_pizza_menu = get_main_pizzas_menu(products, token, message)
+    main_pizza_menu = get_main_pizzas_menu(products, menu_page)
 
-    if message == '/start' or message == 'menu':
+    if menu_page == MAIN_MENU_PAGE:
         pizzas_categories_menu = get_pizzas_categories_menu(categories)
         return first_page_menu + main_pizza_menu + pizzas_categories_menu
     
@@ -93,13 +115,13 @@ def get_first_page_menu():
             }]
 
 
-def get_main_pizzas_menu(products, token, message):
+def get_main_pizzas_menu(products, menu_page):
     menu = []
     for product in products:
         title = f'{product["name"]} ({product["price"]}р.)'
         description = product['description']
-        image_url = moltin.get_image_url(token, product['image_id'])
-        if message == '/start' or message == 'menu':
+        image_url = product['image_url']
+        if menu_page == MAIN_MENU_PAGE:
             buttons = [{
                     'type': 'postback',
                     'title': 'Добавить в корзину',
@@ -148,4 +170,4 @@ def get_pizzas_categories_menu(categories):
             button_count = 0
             buttons = []
 
-    return menu
\ No newline at end of file
+    return menu
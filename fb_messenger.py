@@ -0,0 +1,183 @@
+import json
+import time
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Lock, local
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from more_itertools import chunked
+from environs import Env
+
+import profiling
+
+env = Env()
+
+MAX_BATCH_SIZE = 50
+RATE_LIMIT_ERROR_CODES = (4, 17, 32, 613)
+
+_session = None
+_semaphore = None
+_init_lock = Lock()
+_buffer = local()
+
+
+class MessengerError(Exception):
+    pass
+
+
+def get_api_url():
+    return env('GRAPH_API_URL', 'https://graph.facebook.com/v2.6')
+
+
+def get_session():
+    global _session, _semaphore
+    with _init_lock:
+        if _session is None:
+            concurrency = env.int('MESSENGER_CONCURRENCY', 10)
+            adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+            _session = requests.Session()
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            _semaphore = BoundedSemaphore(concurrency)
+    return _session
+
+
+def is_rate_limited(response):
+    if response.status_code == 429:
+        return True
+    try:
+        return response.json()['error']['code'] in RATE_LIMIT_ERROR_CODES
+    except (ValueError, KeyError, TypeError):
+        return False
+
+
+def is_connect_error(err):
+    if isinstance(err, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(err.args[0], 'reason', None) if err.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def post(path, **kwargs):
+    session = get_session()
+    retries = env.int('MESSENGER_RETRIES', 3)
+    params = {'access_token': env('PAGE_ACCESS_TOKEN')}
+    timeout = env.float('MESSENGER_TIMEOUT', 10)
+
+    # Sends are not idempotent: retry only what Facebook has surely not processed,
+    # a rate limited request or a connection that was never made
+    for attempt in range(retries + 1):
+        try:
+            with _semaphore, profiling.timed('graph', f'POST {path}'):
+                response = session.post(f'{get_api_url()}{path}', params=params, timeout=timeout, **kwargs)
+        except requests.ConnectionError as err:
+            if not is_connect_error(err) or attempt == retries:
+                raise
+        else:
+            if not is_rate_limited(response) or attempt == retries:
+                break
+        time.sleep(env.float('MESSENGER_BACKOFF', 0.5) * 2 ** attempt)
+
+    response.raise_for_status()
+    return response
+
+
+def send_message(recipient_id, message):
+    send_encoded_message(recipient_id, json.dumps(message).encode('utf-8'))
+
+
+def send_encoded_message(recipient_id, message_json):
+    buffered_messages = getattr(_buffer, 'messages', None)
+    if buffered_messages is not None:
+        buffered_messages.append((recipient_id, message_json))
+        return
+
+    recipient = json.dumps({'id': recipient_id}).encode('utf-8')
+    request_content = b'{"recipient": ' + recipient + b', "message": ' + message_json + b'}'
+    headers = {'Content-Type': 'application/json'}
+    post('/me/messages', headers=headers, data=request_content)
+
+
+def get_batch_requests(messages):
+    batch_requests = []
+    last_request_names = {}
+    for message_number, (recipient_id, message_json) in enumerate(messages):
+        batch_request = {
+            'method': 'POST',
+            'name': f'message_{message_number}',
+            'relative_url': 'me/messages',
+            'body': urlencode({
+                'recipient': json.dumps({'id': recipient_id}),
+                'message': message_json,
+            }),
+        }
+        # Requests of a batch run in parallel, so keep the order per user
+        if recipient_id in last_request_names:
+            batch_request['depends_on'] = last_request_names[recipient_id]
+        last_request_names[recipient_id] = batch_request['name']
+        batch_requests.append(batch_request)
+    return batch_requests
+
+
+def is_rate_limited_result(result):
+    if result['code'] == 429:
+        return True
+    try:
+        return json.loads(result['body'])['error']['code'] in RATE_LIMIT_ERROR_CODES
+    except (ValueError, KeyError, TypeError):
+        return False
+
+
+def send_batch(messages):
+    retries = env.int('MESSENGER_RETRIES', 3)
+    for attempt in range(retries + 1):
+        batch_requests = get_batch_requests(messages)
+        response = post('/', data={'batch': json.dumps(batch_requests), 'include_headers': 'false'})
+
+        # Facebook answers null for requests it has not run, they are sent again
+        # with the rate limited ones and the ones that depend on them
+        unsent_messages = []
+        unsent_names = set()
+        for message, batch_request, result in zip(messages, batch_requests, response.json()):
+            if result and result.get('code') == 200:
+                continue
+            if not result or is_rate_limited_result(result) or batch_request.get('depends_on') in unsent_names:
+                unsent_messages.append(message)
+                unsent_names.add(batch_request['name'])
+                continue
+            raise MessengerError(f'Messenger batch request {batch_request["name"]} failed: {result}')
+
+        if not unsent_messages:
+            return
+        messages = unsent_messages
+        if attempt < retries:
+            time.sleep(env.float('MESSENGER_BACKOFF', 0.5) * 2 ** attempt)
+    raise MessengerError(f'{len(messages)} messages of a batch are not sent')
+
+
+def flush(messages):
+    if not messages:
+        return
+    if len(messages) == 1:
+        recipient_id, message_json = messages[0]
+        send_encoded_message(recipient_id, message_json)
+        return
+    for batch_messages in chunked(messages, MAX_BATCH_SIZE):
+        send_batch(batch_messages)
+
+
+@contextmanager
+def batch():
+    if getattr(_buffer, 'messages', None) is not None:
+        yield
+        return
+
+    _buffer.messages = []
+    try:
+        yield
+    finally:
+        messages, _buffer.messages = _buffer.messages, None
+        # A failed send fails the turn, so that its state is not saved
+        flush(messages)
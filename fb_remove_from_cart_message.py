@@ -1,25 +1,11 @@
-import requests
+from functools import partial
 
-from environs import Env
+import cart_debounce
+from fb_cart_changes_message import send_cart_changes
 
-import moltin
 
-env = Env()
+def send_remove_from_cart_message(sender_id, message, token, user, item_id, db, with_cart=False):
+    reply = {'sender_id': sender_id, 'cart': with_cart}
+    on_changed = partial(send_cart_changes, db, token, user, user)
 
-
-def send_remove_from_cart_message(sender_id, message, token, user, item_id):
-    moltin.remove_cart_item(token, user, item_id)
-    params = {'access_token': env('PAGE_ACCESS_TOKEN')}
-    headers = {'Content-Type': 'application/json'}
-    text = f'Убрана из корзины'
-    request_content = {
-        "recipient": {
-            "id": sender_id
-        },
-        "message": {
-            "text": text
-        }
-    }
-    url = 'https://graph.facebook.com/v2.6/me/messages'
-    response = requests.post(url, params=params, headers=headers, json=request_content)
-    response.raise_for_status()
\ No newline at end of file
+    cart_debounce.remove_item(db, token, 'messenger', user, user, item_id, reply, on_changed)
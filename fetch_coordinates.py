@@ -1,12 +1,102 @@
+import re
+import time
+from collections import OrderedDict
+from threading import Lock
+
 import requests
+from environs import Env
+
+import profiling
+import redis_keys
+import serializer
+
+env = Env()
+
+NOT_FOUND = 'not_found'
+
+_local_cache = OrderedDict()
+_lock = Lock()
+_stats = {'local_hits': 0, 'redis_hits': 0, 'misses': 0, 'not_found': 0}
+
 
+def normalize_address(place):
+    place = place.lower().replace('ё', 'е')
+    return ' '.join(re.sub(r'[^\w\s/-]', ' ', place).split())
 
-def fetch_coordinates(place, apikey):
-    base_url = "https://geocode-maps.yandex.ru/1.x"
+
+def fetch_yandex_coordinates(place, apikey):
+    base_url = env('YANDEX_GEOCODER_URL', "https://geocode-maps.yandex.ru/1.x")
     params = {"geocode": place, "apikey": apikey, "format": "json"}
-    response = requests.get(base_url, params=params)
+    with profiling.timed('yandex', 'geocode'):
+        response = requests.get(base_url, params=params, timeout=env.float('YANDEX_TIMEOUT', 5))
     response.raise_for_status()
     places_found = response.json()['response']['GeoObjectCollection']['featureMember']
+    if not places_found:
+        return None
     most_relevant = places_found[0]
     lon, lat = most_relevant['GeoObject']['Point']['pos'].split(" ")
     return lon, lat
+
+
+def count(stat):
+    with _lock:
+        _stats[stat] += 1
+    profiling.increment('geocode_cache_total', {'result': stat})
+
+
+def get_geocode_stats():
+    with _lock:
+        return dict(_stats)
+
+
+def get_local_coordinates(address):
+    with _lock:
+        cached = _local_cache.get(address)
+        if cached is None:
+            return None
+        coordinates, expires_at = cached
+        if expires_at < time.time():
+            del _local_cache[address]
+            return None
+        _local_cache.move_to_end(address)
+        return coordinates
+
+
+def set_local_coordinates(address, coordinates, ttl):
+    with _lock:
+        _local_cache[address] = (coordinates, time.time() + ttl)
+        _local_cache.move_to_end(address)
+        while len(_local_cache) > env.int('GEOCODE_LRU_SIZE', 1024):
+            _local_cache.popitem(last=False)
+
+
+def fetch_coordinates(place, apikey, db=None, geocoder=fetch_yandex_coordinates):
+    address = normalize_address(place)
+    local_ttl = env.int('GEOCODE_LOCAL_TTL', 10 * 60)
+
+    coordinates = get_local_coordinates(address)
+    if coordinates is not None:
+        count('local_hits')
+    else:
+        cached_coordinates = db.get(redis_keys.get_geocode_key(address)) if db is not None else None
+        if cached_coordinates is not None:
+            count('redis_hits')
+            coordinates = serializer.loads(cached_coordinates, 'geocode')
+            set_local_coordinates(address, coordinates, local_ttl)
+        else:
+            count('misses')
+            coordinates = geocoder(place, apikey) or NOT_FOUND
+            if coordinates == NOT_FOUND:
+                ttl = env.int('GEOCODE_NOT_FOUND_TTL', 60 * 60)
+            else:
+                ttl = env.int('GEOCODE_TTL', 30 * 24 * 60 * 60)
+            if db is not None:
+                db.set(redis_keys.get_geocode_key(address), serializer.dumps(coordinates, 'geocode'), ex=ttl)
+            set_local_coordinates(address, coordinates, min(ttl, local_ttl))
+
+    if coordinates == NOT_FOUND:
+        count('not_found')
+        raise IndexError(f'Address {place} is not found')
+
+    lon, lat = coordinates
+    return lon, lat
@@ -0,0 +1,32 @@
+from environs import Env
+
+import moltin
+import redis_keys
+
+env = Env()
+
+
+def get_image_urls(token, db, image_ids):
+    image_ids = list(dict.fromkeys(image_ids))
+    if not image_ids:
+        return {}
+
+    cached_urls = db.hmget(redis_keys.IMAGE_URLS_KEY, image_ids)
+    image_urls = {
+        image_id: image_url.decode('utf-8')
+        for image_id, image_url in zip(image_ids, cached_urls)
+        if image_url
+    }
+
+    missing_ids = [image_id for image_id in image_ids if image_id not in image_urls]
+    if missing_ids:
+        fetched_urls = moltin.get_image_urls(token, missing_ids)
+        pipe = db.pipeline()
+        pipe.hset(redis_keys.IMAGE_URLS_KEY, mapping=fetched_urls)
+        pipe.ttl(redis_keys.IMAGE_URLS_KEY)
+        __, ttl = pipe.execute()
+        if ttl < 0:
+            db.expire(redis_keys.IMAGE_URLS_KEY, env.int('IMAGE_URL_TTL', 24 * 60 * 60))
+        image_urls.update(fetched_urls)
+
+    return image_urls
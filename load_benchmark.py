@@ -0,0 +1,422 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+TELEGRAM_TOKEN = '123456:BENCHMARK'
+CATEGORIES = ['Главная', 'Острые', 'Сытные', 'Особые']
+
+# Webhook skips events with a timestamp it has seen, so they are unique
+_timestamps = itertools.count(int(time.time() * 1000))
+
+
+class StubServer:
+    def __init__(self, name, route, latency, connect_latency=0):
+        self.name = name
+        self.route = route
+        self.latency = latency
+        # Stands for the TCP and TLS handshakes of a real https service
+        self.connect_latency = connect_latency
+        self.requests_count = 0
+        self.connections_count = 0
+        self.lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def setup(self):
+                super().setup()
+                with stub.lock:
+                    stub.connections_count += 1
+                time.sleep(stub.connect_latency)
+
+            def handle_request(self, method):
+                with stub.lock:
+                    stub.requests_count += 1
+                time.sleep(stub.latency)
+                content_length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(content_length) if content_length else b''
+                url = urlparse(self.path)
+                status, content = stub.route(method, url.path, parse_qs(url.query), body)
+                content = json.dumps(content).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self.handle_request('GET')
+
+            def do_POST(self):
+                self.handle_request('POST')
+
+            def do_PUT(self):
+                self.handle_request('PUT')
+
+            def do_DELETE(self):
+                self.handle_request('DELETE')
+
+            def log_message(self, *args):
+                pass
+
+        Handler.protocol_version = 'HTTP/1.1'
+        # Headers and body are written apart, do not wait for the delayed ack between them
+        Handler.disable_nagle_algorithm = True
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MoltinStub:
+    def __init__(self, products_count, pizzerias_count):
+        self.products = [
+            {
+                'id': f'product-{number}',
+                'name': f'Пицца {number}',
+                'description': f'Описание пиццы {number}',
+                'category': CATEGORIES[0] if number < 6 else CATEGORIES[number % len(CATEGORIES)],
+                'price': 300 + number * 10,
+            }
+            for number in range(products_count)
+        ]
+        self.pizzerias = [
+            {
+                'id': f'pizzeria-{number}',
+                'address': f'Москва, улица {number}',
+                'latitude': 55.5 + number % 50 / 100,
+                'longitude': 37.3 + number // 50 % 50 / 100,
+                'deliveryman-chat-id': 1,
+            }
+            for number in range(pizzerias_count)
+        ]
+        self.carts = {}
+        self.error_rate = 0
+        self.lock = threading.Lock()
+
+    def serialize_product(self, product):
+        return {
+            'id': product['id'],
+            'name': product['name'],
+            'description': product['description'],
+            'meta': {'display_price': {'with_tax': {'formatted': str(product['price'])}}},
+            'relationships': {'main_image': {'data': {'id': f'image-{product["id"]}'}}},
+        }
+
+    def serialize_cart(self, cart_id):
+        products = {product['id']: product for product in self.products}
+        items, total_amount = [], 0
+        for item_id, (product_id, quantity) in self.carts.get(cart_id, {}).items():
+            product = products[product_id]
+            total_amount += product['price'] * quantity
+            items.append({
+                'id': item_id,
+                'product_id': product_id,
+                'name': product['name'],
+                'description': product['description'],
+                'quantity': quantity,
+                'image': {'href': f'https://example.com/{product_id}.jpg'},
+                'meta': {'display_price': {'with_tax': {
+                    'unit': {'formatted': str(product['price'])},
+                    'value': {'formatted': str(product['price'] * quantity)},
+                }}},
+            })
+        return {'data': items, 'meta': {'display_price': {'with_tax': {'amount': total_amount}}}}
+
+    def route(self, method, path, query, body):
+        parts = path.strip('/').split('/')
+        if random.random() < self.error_rate:
+            return 503, {'errors': [{'detail': 'Injected error'}]}
+        if path == '/oauth/access_token':
+            return 200, {'access_token': 'benchmark', 'expires': int(time.time()) + 3600}
+        if path == '/v2/products':
+            products = self.products
+            if 'filter' in query:
+                category_id = query['filter'][0].split(',')[1].rstrip(')')
+                products = [product for product in products if product['category'] == category_id]
+            return 200, {'data': [self.serialize_product(product) for product in products], 'links': {}}
+        if path == '/v2/categories':
+            return 200, {'data': [{'id': category, 'name': category} for category in CATEGORIES], 'links': {}}
+        if parts[:2] == ['v2', 'files']:
+            return 200, {'data': {'link': {'href': f'https://example.com/{parts[2]}.jpg'}}}
+        if path == '/v2/flows/pizzerias/entries':
+            return 200, {'data': self.pizzerias, 'links': {}}
+        if path == '/v2/flows/customer-address/entries':
+            return 201, {'data': {}}
+        if parts[:2] == ['v2', 'carts']:
+            cart_id = parts[2]
+            with self.lock:
+                cart = self.carts.setdefault(cart_id, {})
+                if method == 'POST':
+                    item = json.loads(body)['data']
+                    item_id = f'item-{item["id"]}'
+                    __, quantity = cart.get(item_id, (item['id'], 0))
+                    cart[item_id] = (item['id'], quantity + item['quantity'])
+                elif method == 'PUT' and parts[4] in cart:
+                    product_id, __ = cart[parts[4]]
+                    cart[parts[4]] = (product_id, json.loads(body)['data']['quantity'])
+                elif method == 'DELETE' and len(parts) == 5:
+                    cart.pop(parts[4], None)
+                elif method == 'DELETE':
+                    self.carts.pop(cart_id, None)
+                    return 200, {}
+                return 200, self.serialize_cart(cart_id)
+        return 404, {'errors': [{'detail': f'{method} {path} is not stubbed'}]}
+
+
+def route_graph(method, path, query, body):
+    if path.rstrip('/').endswith('v2.6'):
+        batch = json.loads(parse_qs(body.decode('utf-8'))['batch'][0])
+        message_content = json.dumps({'recipient_id': '1', 'message_id': 'mid'})
+        return 200, [{'code': 200, 'body': message_content} for __ in batch]
+    return 200, {'recipient_id': '1', 'message_id': 'mid'}
+
+
+def route_telegram(method, path, query, body):
+    telegram_method = path.rsplit('/', 1)[-1]
+    if telegram_method == 'getMe':
+        return 200, {'ok': True, 'result': {'id': 123456, 'is_bot': True, 'first_name': 'Pizza', 'username': 'pizza_bot'}}
+    if telegram_method == 'getMyCommands':
+        return 200, {'ok': True, 'result': []}
+    if telegram_method.startswith('send') or telegram_method.startswith('edit'):
+        return 200, {'ok': True, 'result': {
+            'message_id': 1,
+            'date': int(time.time()),
+            'chat': {'id': 1, 'type': 'private'},
+        }}
+    return 200, {'ok': True, 'result': True}
+
+
+def route_yandex(method, path, query, body):
+    return 200, {'response': {'GeoObjectCollection': {'featureMember': [
+        {'GeoObject': {'Point': {'pos': '37.61 55.75'}}}
+    ]}}}
+
+
+def start_stubs(latencies, products_count, pizzerias_count):
+    moltin_stub = MoltinStub(products_count, pizzerias_count)
+    stubs = {
+        'moltin': StubServer('moltin', moltin_stub.route, latencies['moltin']),
+        'graph': StubServer('graph', route_graph, latencies['graph']),
+        'telegram': StubServer('telegram', route_telegram, latencies['telegram']),
+        'yandex': StubServer('yandex', route_yandex, latencies['yandex']),
+    }
+    os.environ.update({
+        'MOLTIN_API_URL': stubs['moltin'].url,
+        'GRAPH_API_URL': f'{stubs["graph"].url}/v2.6',
+        'TELEGRAM_API_URL': stubs['telegram'].url,
+        'YANDEX_GEOCODER_URL': stubs['yandex'].url,
+        'MOLTIN_CLIENT_ID': 'benchmark',
+        'MOLTIN_CLIENT_SECRET_TOKEN': 'benchmark',
+        'PAGE_ACCESS_TOKEN': 'benchmark',
+        'TELEGRAM_TOKEN': TELEGRAM_TOKEN,
+        'YANDEX_MAP_KEY': 'benchmark',
+        'MENU_IMAGE': 'https://example.com/menu.jpg',
+        'CATEGORY_IMAGE': 'https://example.com/category.jpg',
+        'CART_IMAGE': 'https://example.com/cart.jpg',
+        'ASYNC_WEBHOOK': 'false',
+    })
+    return moltin_stub, stubs
+
+
+def get_messenger_event(sender_id, message=None, postback=None):
+    messaging_event = {'sender': {'id': sender_id}, 'recipient': {'id': 'page'}, 'timestamp': next(_timestamps)}
+    if message:
+        messaging_event['message'] = {'mid': uuid.uuid4().hex, 'text': message}
+    else:
+        messaging_event['postback'] = {'payload': postback}
+    return {'object': 'page', 'entry': [{'id': 'page', 'messaging': [messaging_event]}]}
+
+
+def run_messenger_flow(client, moltin_stub, sender_id, product_id):
+    cart_id = f'fb_{sender_id}'
+    steps = [
+        lambda: get_messenger_event(sender_id, message='/start'),
+        lambda: get_messenger_event(sender_id, postback=f'start,{CATEGORIES[1]}'),
+        lambda: get_messenger_event(sender_id, postback=f'add_to_cart,{product_id}'),
+        lambda: get_messenger_event(sender_id, postback='cart'),
+        lambda: get_messenger_event(sender_id, postback=f'remove_from_cart,item-{product_id}'),
+        lambda: get_messenger_event(sender_id, postback='delivery'),
+    ]
+    durations = []
+    for get_event in steps:
+        started_at = time.monotonic()
+        client.post('/', data=json.dumps(get_event()), content_type='application/json')
+        durations.append(time.monotonic() - started_at)
+    moltin_stub.carts.pop(cart_id, None)
+    return durations
+
+
+def get_telegram_update(chat_id, text=None, data=None, location=None):
+    user = {'id': chat_id, 'is_bot': False, 'first_name': 'Benchmark'}
+    message = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}, 'from': user}
+    update = {'update_id': int(time.time() * 1000) % 2 ** 31}
+    if data:
+        update['callback_query'] = {
+            'id': uuid.uuid4().hex,
+            'from': user,
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': message,
+        }
+    elif location:
+        update['message'] = dict(message, location=location)
+    else:
+        update['message'] = dict(message, text=text)
+    return update
+
+
+def run_telegram_flow(updater, moltin_stub, chat_id, product_id):
+    from telegram import Update
+
+    steps = [
+        get_telegram_update(chat_id, text='/start'),
+        get_telegram_update(chat_id, data=product_id),
+        get_telegram_update(chat_id, data=product_id),
+        get_telegram_update(chat_id, data=product_id),
+        get_telegram_update(chat_id, data='cart'),
+        get_telegram_update(chat_id, data=f'remove,item-{product_id}'),
+        get_telegram_update(chat_id, data='delivery_choice'),
+        get_telegram_update(chat_id, text='Москва, Тверская улица, 1'),
+        get_telegram_update(chat_id, data='delivery'),
+    ]
+    durations = []
+    for update_content in steps:
+        started_at = time.monotonic()
+        updater.dispatcher.process_update(Update.de_json(update_content, updater.bot))
+        durations.append(time.monotonic() - started_at)
+    moltin_stub.carts.pop(str(chat_id), None)
+    return durations
+
+
+def get_percentile(durations, percentile):
+    if len(durations) < 2:
+        return durations[0] if durations else 0
+    return statistics.quantiles(durations, n=100, method='inclusive')[percentile - 1]
+
+
+def summarize(durations, elapsed, stubs_counts, redis_ops):
+    turns = len(durations)
+    return {
+        'turns': turns,
+        'throughput': turns / elapsed,
+        'p50_ms': get_percentile(durations, 50) * 1000,
+        'p95_ms': get_percentile(durations, 95) * 1000,
+        'p99_ms': get_percentile(durations, 99) * 1000,
+        'calls_per_turn': {name: count / turns for name, count in stubs_counts.items()},
+        'redis_ops_per_turn': redis_ops / turns,
+    }
+
+
+def run_channel(channel, flow, users, concurrency, stubs):
+    import profiling
+
+    def count_redis_ops():
+        return sum(
+            value for (metric, labels), value in profiling.get_counters().items()
+            if metric == 'bot_turn_dependency_calls_total'
+            and ('channel', channel) in labels and ('dependency', 'redis') in labels
+        )
+
+    stubs_counts_before = {name: stub.requests_count for name, stub in stubs.items()}
+    redis_ops_before = count_redis_ops()
+    started_at = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        flows_durations = list(executor.map(flow, range(users)))
+    elapsed = time.monotonic() - started_at
+
+    durations = [duration for flow_durations in flows_durations for duration in flow_durations]
+    stubs_counts = {name: stub.requests_count - stubs_counts_before[name] for name, stub in stubs.items()}
+    return summarize(durations, elapsed, stubs_counts, count_redis_ops() - redis_ops_before)
+
+
+def print_report(results, baseline=None):
+    for channel, result in results.items():
+        print(f'\n{channel}: {result["turns"]} turns, {result["throughput"]:.1f} turns/s')
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'redis_ops_per_turn'):
+            line = f'  {metric}: {result[metric]:.2f}'
+            if baseline and channel in baseline:
+                line += f' (baseline {baseline[channel][metric]:.2f})'
+            print(line)
+        for name, calls in result['calls_per_turn'].items():
+            line = f'  {name} calls per turn: {calls:.2f}'
+            if baseline and channel in baseline:
+                line += f' (baseline {baseline[channel]["calls_per_turn"].get(name, 0):.2f})'
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Drive conversations through both bots against local stub servers')
+    parser.add_argument('--users', type=int, default=50, help='conversations per channel')
+    parser.add_argument('--concurrency', type=int, default=10, help='conversations at once')
+    parser.add_argument('--products', type=int, default=30)
+    parser.add_argument('--pizzerias', type=int, default=100)
+    parser.add_argument('--moltin-latency', type=float, default=50, help='ms')
+    parser.add_argument('--graph-latency', type=float, default=30, help='ms')
+    parser.add_argument('--telegram-latency', type=float, default=30, help='ms')
+    parser.add_argument('--yandex-latency', type=float, default=50, help='ms')
+    parser.add_argument('--channels', default='messenger,telegram')
+    parser.add_argument('--save-baseline', help='write the results to this json file')
+    parser.add_argument('--baseline', help='compare the results with this json file')
+    args = parser.parse_args()
+
+    latencies = {
+        'moltin': args.moltin_latency / 1000,
+        'graph': args.graph_latency / 1000,
+        'telegram': args.telegram_latency / 1000,
+        'yandex': args.yandex_latency / 1000,
+    }
+    moltin_stub, stubs = start_stubs(latencies, args.products, args.pizzerias)
+
+    import app
+    import catalog
+    import tg_pizza_bot
+    from moltin_token import get_token
+
+    db = app.get_database_connection()
+    catalog.refresh_catalog(db, get_token(db))
+    run_id = uuid.uuid4().int % 10 ** 6
+    product_id = next(product['id'] for product in moltin_stub.products if product['category'] == CATEGORIES[1])
+
+    results = {}
+    channels = args.channels.split(',')
+    if 'messenger' in channels:
+        client = app.app.test_client()
+        results['messenger'] = run_channel(
+            'messenger',
+            lambda user: run_messenger_flow(client, moltin_stub, f'bench{run_id}{user}', product_id),
+            args.users, args.concurrency, stubs)
+    if 'telegram' in channels:
+        updater = tg_pizza_bot.create_updater(TELEGRAM_TOKEN)
+        results['telegram'] = run_channel(
+            'telegram',
+            lambda user: run_telegram_flow(updater, moltin_stub, run_id * 10 ** 4 + user, product_id),
+            args.users, args.concurrency, stubs)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(results, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+import argparse
+import json
+import re
+from collections import Counter
+
+import redis
+from environs import Env
+from more_itertools import chunked
+
+import redis_keys
+import serializer
+
+env = Env()
+env.read_env()
+
+TG_STATE_PATTERN = re.compile(r'^(-?\d+)$')
+TG_CART_PATTERN = re.compile(r'^(-?\d+)_cart$')
+TG_PIZZERIA_PATTERN = re.compile(r'^(-?\d+)_pizzeria$')
+FB_STATE_PATTERN = re.compile(r'^fb_(\d+)$')
+USER_KEY_PREFIXES = ('tg_session:', 'fb_state:', 'cart:')
+
+SYNTHETIC_ID_START = 9 * 10 ** 12
+SYNTHETIC_CART = {
+    'items': [{
+        'name': 'Пепперони',
+        'id': '2b6f8d1c-6f1e-4a4b-9a3e-1c6c2b1d5f0a',
+        'product_id': 'c0e3a4b2-1f7d-4c59-8a9e-7e5d3b2a1c0f',
+        'description': 'Пикантная пепперони, увеличенная порция моцареллы, томаты, фирменный томатный соус',
+        'price': '399',
+        'quantity': 2,
+        'amount': '798',
+        'image_url': 'https://files-eu.epusercontent.com/a1b2c3d4/5e6f7a8b.jpg',
+    }],
+    'total_amount': 798,
+}
+SYNTHETIC_PIZZERIA = {
+    'id': '3f2a1b0c-9d8e-4f7a-6b5c-4d3e2f1a0b9c',
+    'address': 'Москва, проспект Мира, 11',
+    'alias': 'mira',
+    'latitude': '55.7733',
+    'longitude': '37.6334',
+    'deliveryman-chat-id': 123456789,
+    'distance': 1.2,
+}
+
+
+def get_database_connection(db_index=0):
+    return redis.Redis(host=env('DATABASE_HOST'),
+                       port=env('DATABASE_PORT'),
+                       password=env('DATABASE_PASSWORD'),
+                       db=db_index)
+
+
+def get_user_ttl(key):
+    if key.startswith('cart:'):
+        return env.int('CART_MIRROR_TTL', 24 * 60 * 60)
+    return redis_keys.get_session_ttl()
+
+
+def migrate_keys(db, keys, stats, dry_run):
+    tg_fields = []
+    fb_states = []
+    legacy_keys = []
+    user_keys = []
+    for key in keys:
+        key = key.decode('utf-8', errors='replace')
+        tg_match = (TG_STATE_PATTERN.match(key) or TG_CART_PATTERN.match(key)
+                    or TG_PIZZERIA_PATTERN.match(key))
+        fb_match = FB_STATE_PATTERN.match(key)
+        if tg_match:
+            field = key.rsplit('_', 1)[1] if '_' in key else 'state'
+            tg_fields.append((key, tg_match.group(1), field))
+        elif fb_match:
+            fb_states.append((key, fb_match.group(1)))
+        elif key in redis_keys.LEGACY_SHARED_KEYS:
+            legacy_keys.append(key)
+        elif key.startswith(USER_KEY_PREFIXES):
+            user_keys.append(key)
+
+    pipe = db.pipeline(transaction=False)
+    for key, __, __ in tg_fields:
+        pipe.get(key)
+    for key, __ in fb_states:
+        pipe.get(key)
+    for key in user_keys:
+        pipe.ttl(key)
+    values = pipe.execute(raise_on_error=False)
+    tg_values = values[:len(tg_fields)]
+    fb_values = values[len(tg_fields):len(tg_fields) + len(fb_states)]
+    user_ttls = values[len(tg_fields) + len(fb_states):]
+
+    session_ttl = redis_keys.get_session_ttl()
+    pipe = db.pipeline(transaction=False)
+    for (key, chat_id, field), value in zip(tg_fields, tg_values):
+        if not isinstance(value, bytes):
+            stats['skipped'] += 1
+            continue
+        # The state was a bare string, the cart and the pizzeria were json
+        if field == 'state':
+            value = value.decode('utf-8')
+        else:
+            value = json.loads(value)
+        session_key = redis_keys.get_tg_session_key(chat_id)
+        pipe.hsetnx(session_key, field, serializer.dumps(value, 'session'))
+        pipe.expire(session_key, session_ttl)
+        pipe.delete(key)
+        stats[f'tg {field}'] += 1
+    for (key, sender_id), value in zip(fb_states, fb_values):
+        if not isinstance(value, bytes):
+            stats['skipped'] += 1
+            continue
+        pipe.set(redis_keys.get_fb_state_key(sender_id), value, nx=True, ex=session_ttl)
+        pipe.delete(key)
+        stats['fb state'] += 1
+    for key in legacy_keys:
+        pipe.delete(key)
+        stats['legacy shared'] += 1
+    for key, ttl in zip(user_keys, user_ttls):
+        if ttl == -1:
+            pipe.expire(key, get_user_ttl(key))
+            stats['expiry added'] += 1
+
+    if not dry_run:
+        pipe.execute()
+
+
+def migrate(db, batch_size, dry_run=False):
+    stats = Counter()
+    for keys in chunked(db.scan_iter(count=batch_size), batch_size):
+        migrate_keys(db, keys, stats, dry_run)
+        stats['scanned'] += len(keys)
+    return stats
+
+
+def write_synthetic_users(db, users_count, batch_size):
+    cart = json.dumps(SYNTHETIC_CART)
+    pizzeria = json.dumps(SYNTHETIC_PIZZERIA)
+    user_ids = range(SYNTHETIC_ID_START, SYNTHETIC_ID_START + users_count)
+    for batch_ids in chunked(user_ids, batch_size):
+        pipe = db.pipeline(transaction=False)
+        for user_id in batch_ids:
+            # Half of the users come from Telegram and half from Messenger
+            if user_id % 2:
+                pipe.set(user_id, 'HANDLE_DELIVERY')
+                pipe.set(f'{user_id}_cart', cart)
+                pipe.set(f'{user_id}_pizzeria', pizzeria)
+            else:
+                pipe.set(f'fb_{user_id}', 'MENU')
+        pipe.execute()
+
+
+def delete_synthetic_users(db, users_count, batch_size):
+    user_ids = range(SYNTHETIC_ID_START, SYNTHETIC_ID_START + users_count)
+    for batch_ids in chunked(user_ids, batch_size):
+        pipe = db.pipeline(transaction=False)
+        for user_id in batch_ids:
+            pipe.delete(user_id, f'{user_id}_cart', f'{user_id}_pizzeria', f'fb_{user_id}',
+                        redis_keys.get_tg_session_key(user_id), redis_keys.get_fb_state_key(user_id))
+        pipe.execute()
+
+
+def get_used_memory(db):
+    return db.info('memory')['used_memory']
+
+
+def report_synthetic_memory(db, users_count, batch_size):
+    empty_memory = get_used_memory(db)
+    write_synthetic_users(db, users_count, batch_size)
+    legacy_memory = get_used_memory(db) - empty_memory
+
+    stats = migrate(db, batch_size)
+    migrated_memory = get_used_memory(db) - empty_memory
+    delete_synthetic_users(db, users_count, batch_size)
+
+    print(f'{users_count} synthetic users, {stats["scanned"]} keys scanned')
+    print(f'legacy keys: {legacy_memory / 2 ** 20:.1f} MiB, {legacy_memory / users_count:.0f} bytes per user')
+    print(f'new keys: {migrated_memory / 2 ** 20:.1f} MiB, {migrated_memory / users_count:.0f} bytes per user')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Move per-user keys to the namespaced layout with expiry')
+    parser.add_argument('--batch-size', type=int, default=1000, help='keys per SCAN and pipeline')
+    parser.add_argument('--dry-run', action='store_true', help='only count the keys to migrate')
+    parser.add_argument('--synthetic-users', type=int,
+                        help='instead of migrating, report memory of this many users before and after '
+                             'migration; use an empty database')
+    parser.add_argument('--db', type=int, default=0, help='database index')
+    args = parser.parse_args()
+
+    db = get_database_connection(args.db)
+    if args.synthetic_users:
+        report_synthetic_memory(db, args.synthetic_users, args.batch_size)
+        return
+
+    stats = migrate(db, args.batch_size, args.dry_run)
+    for name, count in stats.items():
+        print(f'{name}: {count}')
+
+
+if __name__ == '__main__':
+    main()
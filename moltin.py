@@ -1,56 +1,151 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from environs import Env
+from concurrent.futures import ThreadPoolExecutor
 import json
+import time
+
+import profiling
+from circuit_breaker import CircuitBreaker
+
+env = Env()
+
+_session = None
+_breaker = None
+
+# Methods that may be sent again after moltin has got them
+IDEMPOTENT_METHODS = ('GET', 'PUT', 'DELETE')
+
+
+class MoltinUnavailable(requests.RequestException):
+    pass
+
+
+def get_api_url():
+    return env('MOLTIN_API_URL', 'https://api.moltin.com')
+
+
+def get_session():
+    global _session
+    if _session is None:
+        pool_size = env.int('MOLTIN_POOL_SIZE', 10)
+        # call_api retries by itself, so that the breaker sees every attempt
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=0)
+        _session = requests.Session()
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+    return _session
+
+
+def get_breaker():
+    global _breaker
+    if _breaker is None:
+        _breaker = CircuitBreaker('moltin',
+                                  failure_threshold=env.int('MOLTIN_BREAKER_FAILURES', 5),
+                                  reset_timeout=env.float('MOLTIN_BREAKER_RESET_TIMEOUT', 30))
+    return _breaker
+
+
+def is_connect_error(err):
+    if isinstance(err, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(err.args[0], 'reason', None) if err.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def send_request(method, url, deadline, **kwargs):
+    remaining = max(deadline - time.monotonic(), 0.01)
+    connect_timeout = min(env.float('MOLTIN_CONNECT_TIMEOUT', 3.05), remaining)
+    read_timeout = min(env.float('MOLTIN_READ_TIMEOUT', 10), remaining)
+    return get_session().request(method, url, timeout=(connect_timeout, read_timeout), **kwargs)
+
+
+def wait_before_retry(attempt, deadline):
+    delay = env.float('MOLTIN_BACKOFF', 0.3) * 2 ** attempt
+    if attempt >= env.int('MOLTIN_RETRIES', 3) or time.monotonic() + delay >= deadline:
+        return False
+    time.sleep(delay)
+    return True
+
+
+def call_api(method, path, **kwargs):
+    url = path if path.startswith('http') else f'{get_api_url()}{path}'
+    deadline = time.monotonic() + env.float('MOLTIN_DEADLINE', 15)
+
+    breaker = get_breaker()
+    attempt = 0
+    while True:
+        # Every attempt asks the breaker, so retries stop as soon as it opens
+        if not breaker.allow_request():
+            raise MoltinUnavailable(f'Moltin circuit is open, {method} {path} is not sent')
+
+        try:
+            with profiling.timed('moltin', f'{method} {path}'):
+                response = send_request(method, url, deadline, **kwargs)
+        except requests.RequestException as err:
+            breaker.record_failure()
+            # A request that has not reached moltin is safe to send again
+            retryable = method in IDEMPOTENT_METHODS or is_connect_error(err)
+            if not retryable or not wait_before_retry(attempt, deadline):
+                raise MoltinUnavailable(f'{method} {path} failed: {err}') from err
+            attempt += 1
+            continue
+
+        if response.status_code == 429 or response.status_code >= 500:
+            breaker.record_failure()
+            retryable = method in IDEMPOTENT_METHODS or response.status_code == 429
+            if not retryable or not wait_before_retry(attempt, deadline):
+                raise MoltinUnavailable(f'{method} {path} failed with {response.status_code}', response=response)
+            attempt += 1
+            continue
+
+        breaker.record_success()
+        response.raise_for_status()
+        return response
+
+
+def iter_entries(path, headers, params=()):
+    params = list(params) + [('page[limit]', env.int('MOLTIN_PAGE_LIMIT', 100))]
+    response = call_api('GET', path, headers=headers, params=params)
+    while True:
+        page = response.json()
+        yield from page['data']
+        links = page.get('links') or {}
+        next_url = links.get('next')
+        if not page['data'] or not next_url or next_url == links.get('current'):
+            return
+        response = call_api('GET', next_url, headers=headers)
 
 
 # It is managing of the product in the moltin shop
-def get_products_list(token):
+def iter_products(token, category_id=None):
     headers = {
         'Authorization': f'Bearer {token}',
-        'Content-Type': 'application/json',
     }
 
-    url = 'https://api.moltin.com/v2/products/'
+    params = []
+    if category_id:
+        params.append(('filter', f'eq(category.id,{category_id})'))
 
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    products_response = response.json()
-    products = []
-    for product in products_response['data']:
-        products.append({
+    for product in iter_entries('/v2/products', headers, params):
+        yield {
                 'name': product['name'],
                 'id': product['id'],
                 'description': product['description'],
                 'price': product['meta']['display_price']['with_tax']['formatted'],
                 'image_id': product['relationships']['main_image']['data']['id'],
-            })
-
-    return products
+            }
 
 
-def get_products_by_category_id(token, category_id):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
+def get_products_list(token):
+    return list(iter_products(token))
 
-    params = (
-        ('filter', f'eq(category.id,{category_id})'),
-    )
-    url = 'https://api.moltin.com/v2/products'
-    response = requests.get(url, headers=headers, params=params)
-    response.raise_for_status()
-
-    products_response = response.json()
-    products = []
-    for product in products_response['data']:
-        products.append({
-                'name': product['name'],
-                'id': product['id'],
-                'description': product['description'],
-                'price': product['meta']['display_price']['with_tax']['formatted'],
-                'image_id': product['relationships']['main_image']['data']['id'],
-            })
 
-    return products
+def get_products_by_category_id(token, category_id):
+    return list(iter_products(token, category_id))
 
 
 def get_all_categories(token):
@@ -58,11 +153,8 @@ def get_all_categories(token):
         'Authorization': f'Bearer {token}',
     }
 
-    response = requests.get('https://api.moltin.com/v2/categories', headers=headers)
-    response.raise_for_status()
-    categories_response = response.json()['data']
     categories = {}
-    for category in categories_response:
+    for category in iter_entries('/v2/categories', headers):
         categories[category['name']] = category['id']
     
     return categories
@@ -74,10 +166,7 @@ def get_product_by_id(token, product_id):
         'Content-Type': 'application/json',
     }
 
-    url = f'https://api.moltin.com/v2/products/{product_id}'
-
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+    response = call_api('GET', f'/v2/products/{product_id}', headers=headers)
     product = response.json()['data']
 
     image_id = product['relationships']['main_image']['data']['id'] 
@@ -97,15 +186,22 @@ def get_image_url(token, image_id):
         'Authorization': f'Bearer {token}',
     }
 
-    url = f'https://api.moltin.com/v2/files/{image_id}'
-
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+    response = call_api('GET', f'/v2/files/{image_id}', headers=headers)
     image = response.json()
 
     return image['data']['link']['href']
 
 
+def get_image_urls(token, image_ids):
+    image_ids = list(image_ids)
+    if not image_ids:
+        return {}
+    max_workers = min(len(image_ids), env.int('MOLTIN_POOL_SIZE', 10))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        image_urls = executor.map(lambda image_id: get_image_url(token, image_id), image_ids)
+        return dict(zip(image_ids, image_urls))
+
+
 # It is managing of the cart in the moltin shop
 def add_product_to_cart(product_id, token, quantity, chat_id):
     product_data = {
@@ -121,12 +217,10 @@ def add_product_to_cart(product_id, token, quantity, chat_id):
         'Content-Type': 'application/json',
     }
 
-    url = f'https://api.moltin.com/v2/carts/{chat_id}/items'
+    response = call_api('POST', f'/v2/carts/{chat_id}/items',
+                        headers=headers, data=json.dumps(product_data))
 
-    response = requests.post(url,
-                             headers=headers,
-                             data=json.dumps(product_data))
-    response.raise_for_status()
+    return parse_cart(response.json())
 
 
 def get_cart_items(token, chat_id):
@@ -134,12 +228,12 @@ def get_cart_items(token, chat_id):
         'Authorization': f'Bearer {token}',
     }
 
-    url = f'https://api.moltin.com/v2/carts/{chat_id}/items'
+    response = call_api('GET', f'/v2/carts/{chat_id}/items', headers=headers)
+
+    return parse_cart(response.json())
 
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    cart = response.json()
 
+def parse_cart(cart):
     items =[]
     for item in cart['data']:
         items.append({
@@ -162,19 +256,34 @@ def remove_cart_item(token, chat_id, item_id):
     headers = {
         'Authorization': f'Bearer {token}',
     }
-    url = f'https://api.moltin.com/v2/carts/{chat_id}/items/{item_id}'
+    response = call_api('DELETE', f'/v2/carts/{chat_id}/items/{item_id}', headers=headers)
+
+    return parse_cart(response.json())
+
+
+def update_cart_item_quantity(token, chat_id, item_id, quantity):
+    item_data = {
+        "data": {
+            "type": "cart_item",
+            "quantity": int(quantity),
+            }
+        }
+
+    headers = {
+        'Authorization': f'Bearer {token}',
+        'Content-Type': 'application/json',
+    }
+    response = call_api('PUT', f'/v2/carts/{chat_id}/items/{item_id}',
+                        headers=headers, data=json.dumps(item_data))
 
-    response = requests.delete(url, headers=headers)
-    response.raise_for_status()
+    return parse_cart(response.json())
 
 
 def remove_all_cart_items(token, chat_id):
     headers = {
         'Authorization': f'Bearer {token}',
     }
-    url = f'https://api.moltin.com/v2/carts/{chat_id}'
-    response = requests.delete(url, headers=headers)
-    response.raise_for_status()
+    call_api('DELETE', f'/v2/carts/{chat_id}', headers=headers)
 
 
 # It is managing of the user in the moltin shop
@@ -192,10 +301,7 @@ def create_customer(token, username, email, password):
             "password": password
             } 
         }
-    url = 'https://api.moltin.com/v2/customers'
-
-    response = requests.post(url, headers=headers, data=json.dumps(data))
-    response.raise_for_status()
+    call_api('POST', '/v2/customers', headers=headers, data=json.dumps(data))
 
 
 def get_customer(token, customer_id):
@@ -203,10 +309,7 @@ def get_customer(token, customer_id):
         'Authorization': token,
     }
 
-    url = f'https://api.moltin.com/v2/customers/{customer_id}'
-
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+    response = call_api('GET', f'/v2/customers/{customer_id}', headers=headers)
 
     return response.json()
 
@@ -216,11 +319,7 @@ def get_all_pizzerias(token):
         'Authorization': f'Bearer {token}',
     }
 
-    url = 'https://api.moltin.com/v2/flows/pizzerias/entries'
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    
-    return response.json()['data']
+    return list(iter_entries('/v2/flows/pizzerias/entries', headers))
 
 
 def fill_customer_fields(client_id, lat, lon, token):
@@ -238,7 +337,5 @@ def fill_customer_fields(client_id, lat, lon, token):
             } 
         }
 
-    url = 'https://api.moltin.com/v2/flows/customer-address/entries'
-
-    response = requests.post(url, headers=headers, data=json.dumps(data))
-    response.raise_for_status()
\ No newline at end of file
+    call_api('POST', '/v2/flows/customer-address/entries',
+             headers=headers, data=json.dumps(data))
@@ -1,7 +1,12 @@
 from environs import Env
+from threading import Lock
 import time
-import requests
-import json
+
+from redis.exceptions import LockError
+
+import moltin
+import redis_keys
+import serializer
 
 env = Env()
 env.read_env()
@@ -10,24 +15,34 @@ client_id = env('MOLTIN_CLIENT_ID')
 client_secret = env('MOLTIN_CLIENT_SECRET_TOKEN')
 
 
-def get_token(db):
-    current_time = time.time()
-    moltin_token = db.get('moltin_token_info')
+_token = None
+_token_time = 0
+_token_lock = Lock()
+
 
-    if moltin_token and current_time <= float(moltin_token['token_time']):
-        moltin_token['token'] = json.loads(db.get('moltin_token'))
-        return moltin_token['token']
+def is_fresh(token_time):
+    refresh_margin = env.int('MOLTIN_TOKEN_REFRESH_MARGIN', 5 * 60)
+    return time.time() < float(token_time) - refresh_margin
 
+
+def get_shared_token(db):
+    moltin_token = db.get(redis_keys.TOKEN_KEY)
+    if not moltin_token:
+        return None
+    moltin_token = serializer.loads(moltin_token, 'token')
+    if not is_fresh(moltin_token['token_time']):
+        return None
+    return moltin_token
+
+
+def request_token(db):
     data = {
         'client_id': client_id,
         'client_secret': client_secret,
         'grant_type': 'client_credentials'
     }
 
-    url = 'https://api.moltin.com/oauth/access_token'
-
-    response = requests.post(url, data=data)
-    response.raise_for_status()
+    response = moltin.call_api('POST', '/oauth/access_token', data=data)
     access_response = response.json()
 
     moltin_token = {
@@ -35,6 +50,39 @@ def get_token(db):
         'token_time': access_response['expires'],
         }
 
-    db.set('moltin_token', json.dumps(moltin_token))
+    token_ttl = max(int(moltin_token['token_time'] - time.time()), 1)
+    db.set(redis_keys.TOKEN_KEY, serializer.dumps(moltin_token, 'token'), ex=token_ttl)
+
+    return moltin_token
+
+
+def refresh_token(db):
+    moltin_token = get_shared_token(db)
+    if moltin_token:
+        return moltin_token
+
+    lock_timeout = env.int('MOLTIN_TOKEN_LOCK_TIMEOUT', 30)
+    try:
+        with db.lock(redis_keys.TOKEN_LOCK_KEY, timeout=lock_timeout, blocking_timeout=lock_timeout):
+            return get_shared_token(db) or request_token(db)
+    except LockError:
+        return get_shared_token(db) or request_token(db)
+
+
+def get_token(db):
+    global _token, _token_time
+    if _token and is_fresh(_token_time):
+        return _token
+
+    with _token_lock:
+        if not _token or not is_fresh(_token_time):
+            try:
+                moltin_token = refresh_token(db)
+            except moltin.MoltinUnavailable:
+                # Cached catalog reads do not need a valid token, moltin calls fail anyway
+                if not _token:
+                    raise
+                return _token
+            _token, _token_time = moltin_token['token'], moltin_token['token_time']
 
-    return access_response['access_token']
\ No newline at end of file
+    return _token
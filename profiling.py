@@ -0,0 +1,157 @@
+import logging
+import time
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, local
+
+import redis
+from redis.client import Pipeline
+from environs import Env
+
+env = Env()
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BLOCKING_COMMANDS = ('BLPOP', 'BRPOP', 'BRPOPLPUSH')
+
+_lock = Lock()
+_histograms = {}
+_counters = {}
+_turn = local()
+
+
+def get_metric_key(metric, labels):
+    return metric, tuple(sorted((labels or {}).items()))
+
+
+def observe(metric, labels, value):
+    metric_key = get_metric_key(metric, labels)
+    with _lock:
+        histogram = _histograms.setdefault(metric_key, {
+            'buckets': [0] * len(BUCKETS),
+            'sum': 0.0,
+            'count': 0,
+        })
+        for bucket_number, bucket in enumerate(BUCKETS):
+            if value <= bucket:
+                histogram['buckets'][bucket_number] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def increment(metric, labels=None, value=1):
+    metric_key = get_metric_key(metric, labels)
+    with _lock:
+        _counters[metric_key] = _counters.get(metric_key, 0) + value
+
+
+@contextmanager
+def timed(dependency, operation=''):
+    started_at = time.monotonic()
+    try:
+        yield
+    finally:
+        duration = time.monotonic() - started_at
+        observe('bot_dependency_seconds', {'dependency': dependency}, duration)
+        trace = getattr(_turn, 'trace', None)
+        if trace is not None:
+            trace.append((dependency, operation, duration))
+
+
+def set_turn_state(state):
+    _turn.state = state
+
+
+@contextmanager
+def turn(channel):
+    _turn.trace = []
+    _turn.state = 'UNKNOWN'
+    started_at = time.monotonic()
+    try:
+        yield
+    finally:
+        duration = time.monotonic() - started_at
+        trace, _turn.trace = _turn.trace, None
+        state = _turn.state
+        observe('bot_turn_seconds', {'channel': channel, 'state': state}, duration)
+
+        dependencies = {}
+        for dependency, __, call_duration in trace:
+            total_duration, calls_count = dependencies.get(dependency, (0, 0))
+            dependencies[dependency] = (total_duration + call_duration, calls_count + 1)
+        for dependency, (total_duration, calls_count) in dependencies.items():
+            labels = {'channel': channel, 'dependency': dependency}
+            observe('bot_turn_dependency_seconds', labels, total_duration)
+            increment('bot_turn_dependency_calls_total', labels, calls_count)
+
+        if duration * 1000 >= env.int('SLOW_TURN_MS', 1000):
+            calls = ', '.join(
+                f'{dependency} {operation} {call_duration * 1000:.0f} ms'
+                for dependency, operation, call_duration in trace
+            )
+            logging.warning('Slow %s turn in %s: %.0f ms: %s', channel, state, duration * 1000, calls)
+
+
+def profiled_turn(channel):
+    def decorator(handle_users_reply):
+        @wraps(handle_users_reply)
+        def wrapper(*args, **kwargs):
+            with turn(channel):
+                return handle_users_reply(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_counters():
+    with _lock:
+        return dict(_counters)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+def render_metrics():
+    with _lock:
+        histograms = {key: dict(value, buckets=list(value['buckets'])) for key, value in _histograms.items()}
+        counters = dict(_counters)
+
+    lines = []
+    for metric in sorted({metric for metric, __ in histograms}):
+        lines.append(f'# TYPE {metric} histogram')
+        for (histogram_metric, labels), histogram in sorted(histograms.items()):
+            if histogram_metric != metric:
+                continue
+            for bucket, bucket_count in zip(BUCKETS, histogram['buckets']):
+                bucket_labels = labels + (('le', str(bucket)),)
+                lines.append(f'{metric}_bucket{format_labels(bucket_labels)} {bucket_count}')
+            lines.append(f'{metric}_bucket{format_labels(labels + (("le", "+Inf"),))} {histogram["count"]}')
+            lines.append(f'{metric}_sum{format_labels(labels)} {histogram["sum"]}')
+            lines.append(f'{metric}_count{format_labels(labels)} {histogram["count"]}')
+
+    for metric in sorted({metric for metric, __ in counters}):
+        lines.append(f'# TYPE {metric} counter')
+        for (counter_metric, labels), value in sorted(counters.items()):
+            if counter_metric == metric:
+                lines.append(f'{metric}{format_labels(labels)} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+class InstrumentedPipeline(Pipeline):
+    def execute(self, raise_on_error=True):
+        with timed('redis', 'PIPELINE'):
+            return super().execute(raise_on_error)
+
+
+class InstrumentedRedis(redis.Redis):
+    def execute_command(self, *args, **options):
+        if args[0] in BLOCKING_COMMANDS:
+            return super().execute_command(*args, **options)
+        with timed('redis', args[0]):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks,
+                                    transaction, shard_hint)
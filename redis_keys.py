@@ -0,0 +1,71 @@
+from environs import Env
+
+env = Env()
+
+# Shared by all users, rewritten by the bots themselves
+CATALOG_VERSION_KEY = 'catalog_version'
+CATALOG_REFRESH_LOCK_KEY = 'catalog_refresh_lock'
+IMAGE_URLS_KEY = 'image_urls'
+TOKEN_KEY = 'moltin_token'
+TOKEN_LOCK_KEY = 'moltin_token_lock'
+WEBHOOK_QUEUE_KEY = 'fb_events'
+DUPLICATE_EVENTS_KEY = 'fb_duplicate_events'
+
+# Written by the first versions of the bots, nothing reads them now
+LEGACY_SHARED_KEYS = (
+    'menu',
+    'products',
+    'categories',
+    'products_by_categories',
+    'product_by_categories',
+    'moltin_token_info',
+)
+
+
+def get_catalog_key(version):
+    return f'catalog:{version}'
+
+
+def get_fb_menu_key(version):
+    return f'fb_menu:{version}'
+
+
+def get_geocode_key(address):
+    return f'geocode:{address}'
+
+
+def get_webhook_queue_key(shard):
+    return f'{WEBHOOK_QUEUE_KEY}:{shard}'
+
+
+def get_cart_flush_due_key(channel):
+    return f'cart_flush_due:{channel}'
+
+
+# Every key of a user has a namespace and expires
+def get_tg_session_key(chat_id):
+    return f'tg_session:{chat_id}'
+
+
+def get_fb_state_key(sender_id):
+    return f'fb_state:{sender_id}'
+
+
+def get_cart_key(cart_id):
+    return f'cart:{cart_id}'
+
+
+def get_cart_changes_key(cart_id):
+    return f'cart_changes:{cart_id}'
+
+
+def get_lock_key(user):
+    return f'lock:{user}'
+
+
+def get_fb_event_key(event_id):
+    return f'fb_event:{event_id}'
+
+
+def get_session_ttl():
+    return env.int('SESSION_TTL', 30 * 24 * 60 * 60)
@@ -0,0 +1,59 @@
+import json
+
+from environs import Env
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+env = Env()
+
+# Blobs start with a zero byte, which json never does, then the header:
+# format version, payload format and schema tag ended with another zero byte
+MAGIC = b'\x00'
+FORMAT_VERSION = 1
+MSGPACK_FORMAT = b'm'
+JSON_FORMAT = b'j'
+
+
+def get_format():
+    default_format = 'msgpack' if msgpack else 'json'
+    if env('SERIALIZER', default_format) == 'msgpack':
+        if not msgpack:
+            raise RuntimeError('SERIALIZER is msgpack, but msgpack is not installed')
+        return MSGPACK_FORMAT
+    return JSON_FORMAT
+
+
+def dumps(value, schema):
+    payload_format = get_format()
+    if payload_format == MSGPACK_FORMAT:
+        payload = msgpack.packb(value, use_bin_type=True)
+    else:
+        payload = json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    header = MAGIC + bytes([FORMAT_VERSION]) + payload_format + schema.encode('utf-8') + MAGIC
+    return header + payload
+
+
+def loads(data, schema):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if not data.startswith(MAGIC):
+        # Written before the serializer, as plain json
+        return json.loads(data)
+
+    header_end = data.index(MAGIC, 3)
+    version, payload_format = data[1], data[2:3]
+    blob_schema = data[3:header_end].decode('utf-8')
+    if version > FORMAT_VERSION:
+        raise ValueError(f'Blob of format version {version} is newer than {FORMAT_VERSION}')
+    if blob_schema != schema:
+        raise ValueError(f'Blob of schema {blob_schema} is read as {schema}')
+
+    payload = data[header_end + 1:]
+    if payload_format == MSGPACK_FORMAT:
+        if not msgpack:
+            raise RuntimeError('Blob is packed with msgpack, but msgpack is not installed')
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+    return json.loads(payload)
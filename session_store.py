@@ -0,0 +1,21 @@
+import redis_keys
+import serializer
+
+
+def load_session(db, chat_id):
+    session = db.hgetall(redis_keys.get_tg_session_key(chat_id))
+    return {
+        field.decode('utf-8'): serializer.loads(value, 'session')
+        for field, value in session.items()
+    }
+
+
+def save_session(db, chat_id, session):
+    session_key = redis_keys.get_tg_session_key(chat_id)
+    pipe = db.pipeline()
+    pipe.hset(session_key, mapping={
+        field: serializer.dumps(value, 'session')
+        for field, value in session.items()
+    })
+    pipe.expire(session_key, redis_keys.get_session_ttl())
+    pipe.execute()
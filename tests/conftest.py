@@ -0,0 +1,108 @@
+import json
+import os
+from urllib.parse import parse_qs
+
+os.environ.update({
+    'MOLTIN_CLIENT_ID': 'test',
+    'MOLTIN_CLIENT_SECRET_TOKEN': 'test',
+    'DATABASE_HOST': 'localhost',
+    'DATABASE_PORT': '6379',
+    'DATABASE_PASSWORD': '',
+    'PAGE_ACCESS_TOKEN': 'test',
+    'VERIFY_TOKEN': 'test',
+    'TELEGRAM_TOKEN': '123456:TEST',
+    'YANDEX_MAP_KEY': 'test',
+    'MENU_IMAGE': 'https://example.com/menu.jpg',
+    'CATEGORY_IMAGE': 'https://example.com/category.jpg',
+    'CART_IMAGE': 'https://example.com/cart.jpg',
+})
+
+import fakeredis
+import pytest
+import redis
+
+import catalog
+import fb_messenger
+import moltin
+import moltin_token
+import profiling
+from load_benchmark import MoltinStub, StubServer, route_graph, route_telegram, route_yandex
+
+
+class GraphStub:
+    def __init__(self):
+        self.requests = []
+        self.failures = []
+
+    def route(self, method, path, query, body):
+        self.requests.append((path, body))
+        if self.failures:
+            return self.failures.pop(0)
+        return route_graph(method, path, query, body)
+
+    def get_batches(self):
+        return [
+            json.loads(parse_qs(body.decode('utf-8'))['batch'][0])
+            for path, body in self.requests if path.rstrip('/').endswith('v2.6')
+        ]
+
+
+@pytest.fixture
+def redis_server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def db(redis_server):
+    pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection, server=redis_server)
+    return profiling.InstrumentedRedis(connection_pool=pool)
+
+
+@pytest.fixture
+def moltin_stub():
+    return MoltinStub(products_count=30, pizzerias_count=100)
+
+
+@pytest.fixture
+def moltin_server(moltin_stub, monkeypatch):
+    server = StubServer('moltin', moltin_stub.route, latency=0)
+    monkeypatch.setenv('MOLTIN_API_URL', server.url)
+    monkeypatch.setattr(moltin, '_session', None)
+    monkeypatch.setattr(moltin, '_breaker', None)
+    monkeypatch.setattr(moltin_token, '_token', None)
+    monkeypatch.setattr(moltin_token, '_token_time', 0)
+    monkeypatch.setattr(catalog, '_catalog', None)
+    monkeypatch.setattr(catalog, '_catalog_version', None)
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def telegram_server(monkeypatch):
+    server = StubServer('telegram', route_telegram, latency=0)
+    monkeypatch.setenv('TELEGRAM_API_URL', server.url)
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def yandex_server(monkeypatch):
+    server = StubServer('yandex', route_yandex, latency=0)
+    monkeypatch.setenv('YANDEX_GEOCODER_URL', server.url)
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def graph_stub():
+    return GraphStub()
+
+
+@pytest.fixture
+def graph_server(graph_stub, monkeypatch):
+    server = StubServer('graph', graph_stub.route, latency=0)
+    monkeypatch.setenv('GRAPH_API_URL', f'{server.url}/v2.6')
+    monkeypatch.setenv('MESSENGER_BACKOFF', '0')
+    monkeypatch.setattr(fb_messenger, '_session', None)
+    yield server
+    server.close()
@@ -0,0 +1,170 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import parse_qs
+
+import pytest
+from telegram import Update
+
+import cart_debounce
+import cart_mirror
+import catalog
+import redis_keys
+import session_store
+import tg_pizza_bot
+import user_lock
+from fb_add_to_cart_message import send_add_to_cart_message
+from fb_cart_changes_message import CART_UNAVAILABLE_MESSAGE, send_cart_changes
+from fb_remove_from_cart_message import send_remove_from_cart_message
+from load_benchmark import get_telegram_update
+
+TELEGRAM_TOKEN = '123456:TEST'
+CHAT_ID = 1001
+SENDER_ID = '2001'
+USER = f'fb_{SENDER_ID}'
+WINDOW_MS = 50
+
+
+def get_sent_messages(graph_stub):
+    messages = []
+    for path, body in graph_stub.requests:
+        if path.endswith('/me/messages'):
+            messages.append(json.loads(body)['message'])
+        else:
+            for batch_request in json.loads(parse_qs(body.decode('utf-8'))['batch'][0]):
+                messages.append(json.loads(parse_qs(batch_request['body'])['message'][0]))
+    return messages
+
+
+def flush_due_changes(db):
+    cart_debounce.flush_due_changes(db, lambda: 'token', 'messenger', send_cart_changes)
+
+
+@pytest.fixture
+def debounce(db, moltin_server, graph_server, monkeypatch):
+    monkeypatch.setenv('CART_DEBOUNCE_MS', str(WINDOW_MS))
+    catalog.get_catalog(db, 'token')
+
+
+def test_interleaved_taps_fold_into_target_quantities():
+    cart = {'items': [
+        {'id': 'item-a', 'product_id': 'a', 'quantity': 2},
+        {'id': 'item-b', 'product_id': 'b', 'quantity': 1},
+    ]}
+    changes = [
+        {'product_id': 'a', 'quantity': 1},
+        {'item_id': 'item-a'},
+        {'product_id': 'a', 'quantity': 1},
+        {'product_id': 'c', 'quantity': 1},
+        {'item_id': 'item-b'},
+        {'product_id': 'b', 'quantity': 1},
+        {'product_id': 'c', 'quantity': 1},
+        {'item_id': 'item-unknown'},
+    ]
+
+    assert cart_debounce.get_target_quantities(cart, changes) == {'a': 1, 'b': 1, 'c': 2}
+
+
+def test_interleaved_taps_change_only_what_differs(db, moltin_server, moltin_stub):
+    first_id, second_id, third_id = (product['id'] for product in moltin_stub.products[:3])
+    cart_mirror.add_product(db, 'token', USER, first_id, 2)
+    cart_mirror.add_product(db, 'token', USER, second_id, 1)
+    requests_count = moltin_server.requests_count
+    changes = [
+        {'item_id': f'item-{first_id}'},
+        {'product_id': first_id, 'quantity': 1},
+        {'product_id': second_id, 'quantity': 1},
+        {'item_id': f'item-{second_id}'},
+        {'product_id': second_id, 'quantity': 1},
+        {'product_id': third_id, 'quantity': 1},
+    ]
+
+    cart = cart_debounce.apply_changes(db, 'token', USER, changes)
+
+    assert {item['product_id']: item['quantity'] for item in cart['items']} == {first_id: 1, second_id: 1, third_id: 1}
+    # A PUT for the first pizza and a POST for the third, the second one is as it was
+    assert moltin_server.requests_count == requests_count + 2
+    assert cart_mirror.get_cart(db, 'token', USER) == cart
+
+
+def test_taps_wait_in_the_database_for_any_process(db, debounce, moltin_stub, moltin_server, graph_stub):
+    first_id, second_id = (product['id'] for product in moltin_stub.products[:2])
+    cart_mirror.add_product(db, 'token', USER, first_id, 1)
+    requests_count = moltin_server.requests_count
+
+    send_add_to_cart_message(SENDER_ID, second_id, 'token', USER, db)
+    send_remove_from_cart_message(SENDER_ID, 'remove', 'token', USER, f'item-{first_id}', db, with_cart=True)
+    send_add_to_cart_message(SENDER_ID, second_id, 'token', USER, db)
+
+    flush_due_changes(db)
+    assert moltin_server.requests_count == requests_count
+    assert not graph_stub.requests
+
+    time.sleep(WINDOW_MS / 1000)
+    flush_due_changes(db)
+
+    assert {product_id: quantity for product_id, quantity in moltin_stub.carts[USER].values()} == {second_id: 2}
+    text_message, cart_message = get_sent_messages(graph_stub)
+    second_name = catalog.get_product(db, 'token', second_id)['name']
+    assert text_message['text'] == f'Пицца {second_name} добавлена в корзину\nУбрана из корзины'
+    assert cart_message['attachment']['payload']['template_type'] == 'generic'
+    assert not db.exists(redis_keys.get_cart_changes_key(USER))
+
+
+def test_due_changes_are_applied_once(db, debounce, moltin_stub, moltin_server, graph_stub):
+    product_id = moltin_stub.products[0]['id']
+    send_add_to_cart_message(SENDER_ID, product_id, 'token', USER, db)
+    time.sleep(WINDOW_MS / 1000)
+
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda __: flush_due_changes(db), range(4)))
+
+    assert moltin_stub.carts[USER] == {f'item-{product_id}': (product_id, 1)}
+    assert len(get_sent_messages(graph_stub)) == 1
+
+
+def test_unavailable_moltin_is_reported(db, debounce, moltin_stub, graph_stub, monkeypatch):
+    monkeypatch.setenv('MOLTIN_RETRIES', '0')
+    monkeypatch.setenv('MOLTIN_BREAKER_FAILURES', '100')
+    send_add_to_cart_message(SENDER_ID, moltin_stub.products[0]['id'], 'token', USER, db)
+    time.sleep(WINDOW_MS / 1000)
+
+    moltin_stub.error_rate = 1
+    flush_due_changes(db)
+
+    assert get_sent_messages(graph_stub) == [{'text': CART_UNAVAILABLE_MESSAGE}]
+
+
+def test_busy_user_puts_changes_off(db, debounce, moltin_stub, graph_stub, monkeypatch):
+    monkeypatch.setenv('USER_LOCK_TIMEOUT', '1')
+    send_add_to_cart_message(SENDER_ID, moltin_stub.products[0]['id'], 'token', USER, db)
+    time.sleep(WINDOW_MS / 1000)
+
+    with user_lock.hold_lock(db, USER):
+        flush_due_changes(db)
+    assert not graph_stub.requests
+
+    time.sleep(WINDOW_MS / 1000)
+    flush_due_changes(db)
+    assert len(get_sent_messages(graph_stub)) == 1
+
+
+def test_telegram_removal_edits_the_cart_once_applied(db, debounce, moltin_stub, moltin_server, telegram_server,
+                                                      monkeypatch):
+    monkeypatch.setattr(tg_pizza_bot, '_database', db)
+    updater = tg_pizza_bot.create_updater(TELEGRAM_TOKEN)
+    product_id = moltin_stub.products[0]['id']
+    cart = cart_mirror.add_product(db, 'token', CHAT_ID, product_id, 1)
+    session_store.save_session(db, CHAT_ID, {'state': 'HANDLE_CART', 'cart': cart})
+
+    update_content = get_telegram_update(CHAT_ID, data=f'remove,item-{product_id}')
+    updater.dispatcher.process_update(Update.de_json(update_content, updater.bot))
+    assert moltin_stub.carts[str(CHAT_ID)]
+    telegram_requests_count = telegram_server.requests_count
+
+    time.sleep(WINDOW_MS / 1000)
+    cart_debounce.flush_due_changes(db, lambda: 'token', 'telegram', partial(tg_pizza_bot.send_cart_changes, updater.bot))
+
+    assert not moltin_stub.carts[str(CHAT_ID)]
+    assert telegram_server.requests_count == telegram_requests_count + 1
@@ -0,0 +1,28 @@
+from types import SimpleNamespace
+
+import cart_mirror
+import tg_keyboard
+
+CART_ID = '1001'
+PIZZERIA = {'address': 'Москва, улица 1', 'customer_lat': 55.75, 'customer_lon': 37.61}
+
+
+def test_mirror_keeps_sync_time_to_itself(db, moltin_server, moltin_stub):
+    product_id = moltin_stub.products[0]['id']
+
+    cart = cart_mirror.add_product(db, 'token', CART_ID, product_id, 2)
+    assert set(cart) == {'items', 'total_amount'}
+    assert cart_mirror.get_cart(db, 'token', CART_ID) == cart
+    assert moltin_server.requests_count == 1
+
+
+def test_delivery_reply_copies_only_cart_fields(db, moltin_server, moltin_stub):
+    product = moltin_stub.products[0]
+    cart_mirror.add_product(db, 'token', CART_ID, product['id'], 2)
+    session_cart = {'items': [], 'total_amount': 0, 'delivery_fee': 100}
+    query = SimpleNamespace(message=SimpleNamespace(chat_id=CART_ID), data='delivery')
+
+    __, __, cart = tg_keyboard.get_delivery_reply(db, 'token', query, PIZZERIA, session_cart)
+
+    assert set(cart) == {'items', 'total_amount', 'delivery_fee', 'delivery', 'delivery_message'}
+    assert cart['total_amount'] == product['price'] * 2 + 100
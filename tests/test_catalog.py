@@ -0,0 +1,62 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import catalog
+import moltin
+import redis_keys
+
+
+@pytest.fixture(autouse=True)
+def local_catalog(monkeypatch):
+    monkeypatch.setattr(catalog, '_catalog', None)
+    monkeypatch.setattr(catalog, '_catalog_version', None)
+
+
+@pytest.fixture
+def moltin_paths(moltin_server):
+    paths = Counter()
+    route = moltin_server.route
+
+    def count_route(method, path, query, body):
+        paths[path] += 1
+        return route(method, path, query, body)
+
+    moltin_server.route = count_route
+    return paths
+
+
+def test_cold_catalog_is_built_once(db, moltin_server, moltin_paths):
+    moltin_server.latency = 0.05
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        catalogs = list(executor.map(lambda __: catalog.get_catalog(db, 'token'), range(8)))
+
+    assert moltin_paths['/v2/categories'] == 1
+    assert len({menu_catalog['version'] for menu_catalog in catalogs}) == 1
+    assert len(catalogs[0]['products']) == 30
+
+
+def test_stale_catalog_is_served_while_another_process_builds(db, moltin_server, moltin_paths, monkeypatch):
+    stale_catalog = {'version': '1', 'products': []}
+    monkeypatch.setattr(catalog, '_catalog', stale_catalog)
+    monkeypatch.setattr(catalog, '_catalog_version', '1')
+    db.set(redis_keys.CATALOG_REFRESH_LOCK_KEY, 1)
+
+    assert catalog.get_catalog(db, 'token') is stale_catalog
+    assert not moltin_paths
+
+
+def test_failed_build_lets_the_next_turn_try(db, moltin_server, moltin_stub, monkeypatch):
+    # The failed attempts must not open the circuit of moltin for the next turn
+    monkeypatch.setenv('MOLTIN_BREAKER_FAILURES', '100')
+    monkeypatch.setenv('MOLTIN_BACKOFF', '0')
+    moltin_stub.error_rate = 1
+
+    with pytest.raises(moltin.MoltinUnavailable):
+        catalog.get_catalog(db, 'token')
+    assert not db.exists(redis_keys.CATALOG_REFRESH_LOCK_KEY)
+
+    moltin_stub.error_rate = 0
+    assert len(catalog.get_catalog(db, 'token')['products']) == 30
@@ -0,0 +1,38 @@
+import timeit
+
+import catalog
+
+CATALOG_SIZES = (100, 1000, 10000)
+
+
+def get_products(products_count):
+    return [
+        {'id': f'product-{number}', 'name': f'Пицца {number}', 'price': str(300 + number)}
+        for number in range(products_count)
+    ]
+
+
+def find_product(products, product_id):
+    # How the handlers looked a product up before the index
+    return next(product for product in products if product['id'] == product_id)
+
+
+def test_product_lookup_does_not_grow_with_catalog(monkeypatch):
+    monkeypatch.setattr(catalog, '_catalog', None)
+    monkeypatch.setattr(catalog, '_catalog_version', None)
+    lookup_times, scan_times = {}, {}
+    for products_count in CATALOG_SIZES:
+        menu_catalog = {'products': get_products(products_count), 'pizzerias': []}
+        catalog.set_local_catalog(menu_catalog, '1')
+        product_id = f'product-{products_count - 1}'
+
+        lookup_times[products_count] = min(timeit.repeat(
+            lambda: menu_catalog['products_by_id'][product_id], number=1000, repeat=5)) / 1000
+        scan_times[products_count] = min(timeit.repeat(
+            lambda: find_product(menu_catalog['products'], product_id), number=10, repeat=5)) / 10
+        print(f'\n{products_count} products: index {lookup_times[products_count] * 10 ** 9:.0f} ns, '
+              f'scan {scan_times[products_count] * 10 ** 6:.1f} us', end='')
+
+    assert lookup_times[10000] < lookup_times[100] * 3
+    assert scan_times[10000] > scan_times[100] * 30
+    assert lookup_times[10000] * 100 < scan_times[10000]
@@ -0,0 +1,97 @@
+import random
+import time
+
+from geopy import distance
+
+import closest_pizzeria
+
+
+def get_pizzerias(pizzerias_count, rng):
+    return [
+        {
+            'id': f'pizzeria-{number}',
+            'latitude': str(55.5 + rng.random() * 0.5),
+            'longitude': str(37.3 + rng.random() * 0.6),
+        }
+        for number in range(pizzerias_count)
+    ]
+
+
+def find_closest_by_brute_force(lon, lat, pizzerias):
+    return min(
+        pizzerias,
+        key=lambda pizzeria: distance.distance((pizzeria['latitude'], pizzeria['longitude']), (lat, lon)).km,
+    )
+
+
+def get_sphere_distance(first_point, second_point):
+    return closest_pizzeria.get_sphere_distance(closest_pizzeria.get_squared_chord(
+        closest_pizzeria.get_unit_vector(*first_point), closest_pizzeria.get_unit_vector(*second_point)))
+
+
+def test_no_pizzerias():
+    pizzerias_index = closest_pizzeria.build_pizzerias_index([])
+
+    assert closest_pizzeria.get_closest_pizzeria(37.6, 55.7, pizzerias_index) is None
+
+
+def test_same_pizzeria_as_brute_force():
+    rng = random.Random(6)
+    pizzerias = get_pizzerias(200, rng)
+    pizzerias_index = closest_pizzeria.build_pizzerias_index(pizzerias)
+
+    for __ in range(100):
+        lon, lat = 37.2 + rng.random() * 0.8, 55.4 + rng.random() * 0.7
+        expected = find_closest_by_brute_force(lon, lat, pizzerias)
+        assert closest_pizzeria.get_closest_pizzeria(lon, lat, pizzerias_index)['id'] == expected['id']
+
+
+def test_geodesic_closest_pizzeria_that_is_farther_on_the_sphere():
+    # At the equator a degree of latitude is the shortest on the ellipsoid and a
+    # degree of longitude is the longest, so the order of these two flips
+    pizzerias = [
+        {'id': 'east', 'latitude': '0', 'longitude': '0.0899'},
+        {'id': 'north', 'latitude': '0.0903', 'longitude': '0'},
+    ]
+    east_distance = get_sphere_distance((0, 0), (0, 0.0899))
+    north_distance = get_sphere_distance((0, 0), (0.0903, 0))
+    assert east_distance < north_distance
+
+    pizzerias_index = closest_pizzeria.build_pizzerias_index(pizzerias)
+    closest = closest_pizzeria.get_closest_pizzeria(0, 0, pizzerias_index)
+    assert closest['id'] == find_closest_by_brute_force(0, 0, pizzerias)['id'] == 'north'
+
+
+def test_candidates_margin_covers_ellipsoid():
+    rng = random.Random(6)
+    for __ in range(200):
+        lat, lon = rng.uniform(-80, 80), rng.uniform(-180, 180)
+        ratios = []
+        for bearing in range(0, 360, 15):
+            destination = distance.distance(kilometers=10).destination((lat, lon), bearing)
+            ratios.append(10 / get_sphere_distance((lat, lon), (destination.latitude, destination.longitude)))
+        assert max(ratios) / min(ratios) < closest_pizzeria.CANDIDATES_MARGIN
+
+
+def test_closest_of_10000_pizzerias():
+    rng = random.Random(6)
+    pizzerias = get_pizzerias(10000, rng)
+    pizzerias_index = closest_pizzeria.build_pizzerias_index(pizzerias)
+    targets = [(37.2 + rng.random() * 0.8, 55.4 + rng.random() * 0.7) for __ in range(100)]
+
+    started_at = time.monotonic()
+    closest_ids = [
+        closest_pizzeria.get_closest_pizzeria(lon, lat, pizzerias_index)['id']
+        for lon, lat in targets
+    ]
+    index_time = (time.monotonic() - started_at) / len(targets)
+
+    started_at = time.monotonic()
+    lon, lat = targets[0]
+    expected = find_closest_by_brute_force(lon, lat, pizzerias)
+    brute_force_time = time.monotonic() - started_at
+
+    print(f'\n10000 pizzerias: {index_time * 1000:.2f} ms with the k-d tree, '
+          f'{brute_force_time * 1000:.0f} ms by brute force')
+    assert closest_ids[0] == expected['id']
+    assert index_time * 50 < brute_force_time
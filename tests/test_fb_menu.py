@@ -0,0 +1,69 @@
+import json
+import time
+
+import catalog
+import fb_menu_keyboard
+import redis_keys
+
+REQUESTS_COUNT = 200
+
+
+def test_menu_messages_are_published_with_catalog(db, moltin_server, monkeypatch):
+    monkeypatch.setattr(fb_menu_keyboard, '_menu_messages', (None, {}))
+
+    menu_catalog = catalog.get_catalog(db, 'token')
+
+    menu_messages = db.hgetall(redis_keys.get_fb_menu_key(menu_catalog['version']))
+    assert set(menu_messages) == {menu_page.encode('utf-8') for menu_page in ['menu', *menu_catalog['categories']]}
+
+
+def test_failed_renderer_does_not_stop_publishing(db, moltin_server, monkeypatch):
+    monkeypatch.setattr(fb_menu_keyboard, '_menu_messages', (None, {}))
+    render_menu_messages = fb_menu_keyboard.render_menu_messages
+
+    def fail_to_render(menu_catalog):
+        raise KeyError('Главная')
+
+    monkeypatch.setattr(fb_menu_keyboard, 'render_menu_messages', fail_to_render)
+    menu_catalog = catalog.get_catalog(db, 'token')
+
+    assert db.get(redis_keys.CATALOG_VERSION_KEY).decode('utf-8') == menu_catalog['version']
+    assert not db.exists(redis_keys.get_fb_menu_key(menu_catalog['version']))
+
+    # The first reply renders the menu the publisher could not
+    monkeypatch.setattr(fb_menu_keyboard, 'render_menu_messages', render_menu_messages)
+    assert 'menu' in fb_menu_keyboard.get_menu_messages(db, 'token')
+    assert db.exists(redis_keys.get_fb_menu_key(menu_catalog['version']))
+
+
+def render_menu_page(db, menu_page):
+    # What every menu reply did before the messages were prepared
+    elements = fb_menu_keyboard.get_menu_keyboard_content(catalog.get_catalog(db, 'token'), menu_page)
+    template_message = {
+        'attachment': {
+            'type': 'template',
+            'payload': {'template_type': 'generic', 'image_aspect_ratio': 'square', 'elements': elements},
+        }
+    }
+    return json.dumps(template_message).encode('utf-8')
+
+
+def test_prepared_menu_against_rendering_per_request(db, moltin_server, monkeypatch):
+    monkeypatch.setattr(fb_menu_keyboard, '_menu_messages', (None, {}))
+    menu_catalog = catalog.get_catalog(db, 'token')
+    assert fb_menu_keyboard.get_menu_messages(db, 'token')['menu'] == render_menu_page(db, 'menu')
+
+    started_at = time.monotonic()
+    for __ in range(REQUESTS_COUNT):
+        render_menu_page(db, 'menu')
+    rendering_time = time.monotonic() - started_at
+
+    started_at = time.monotonic()
+    for __ in range(REQUESTS_COUNT):
+        fb_menu_keyboard.get_menu_messages(db, 'token')['menu']
+    prepared_time = time.monotonic() - started_at
+
+    print(f'\nmenu of {len(menu_catalog["products"])} products: '
+          f'{rendering_time / REQUESTS_COUNT * 1e6:.0f} us rendered per request, '
+          f'{prepared_time / REQUESTS_COUNT * 1e6:.0f} us prepared')
+    assert prepared_time * 2 < rendering_time
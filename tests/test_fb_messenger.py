@@ -0,0 +1,150 @@
+import json
+import time
+from urllib.parse import parse_qs
+
+import pytest
+import requests
+
+import app
+import fb_messenger
+import redis_keys
+
+SENDER_ID = '2001'
+
+
+def test_batch_keeps_order_per_recipient(graph_server, graph_stub):
+    with fb_messenger.batch():
+        for message_number in range(60):
+            fb_messenger.send_message(f'user{message_number % 3}', {'text': str(message_number)})
+
+    batches = graph_stub.get_batches()
+    assert [len(batch_requests) for batch_requests in batches] == [50, 10]
+    first_batch = batches[0]
+    assert 'depends_on' not in first_batch[0]
+    assert first_batch[3]['depends_on'] == first_batch[0]['name']
+    assert first_batch[4]['depends_on'] == first_batch[1]['name']
+
+
+def test_batch_throughput(graph_server, graph_stub):
+    graph_server.latency = 0.01
+    messages_count = 50
+
+    started_at = time.monotonic()
+    for message_number in range(messages_count):
+        fb_messenger.send_message(f'user{message_number % 10}', {'text': str(message_number)})
+    unbatched_time = time.monotonic() - started_at
+
+    started_at = time.monotonic()
+    with fb_messenger.batch():
+        for message_number in range(messages_count):
+            fb_messenger.send_message(f'user{message_number % 10}', {'text': str(message_number)})
+    batched_time = time.monotonic() - started_at
+
+    print(f'\n{messages_count} messages with 10 ms Graph latency: '
+          f'{messages_count / unbatched_time:.0f} messages/s one by one, '
+          f'{messages_count / batched_time:.0f} messages/s in a batch')
+    assert graph_server.requests_count == messages_count + 1
+    assert batched_time * 10 < unbatched_time
+
+
+def test_server_error_is_not_retried(graph_server, graph_stub):
+    graph_stub.failures = [(500, {'error': {'code': 2, 'message': 'Service temporarily unavailable'}})]
+
+    with pytest.raises(requests.HTTPError):
+        fb_messenger.send_message(SENDER_ID, {'text': 'hello'})
+    assert graph_server.requests_count == 1
+
+
+def test_rate_limited_send_is_retried(graph_server, graph_stub):
+    graph_stub.failures = [(400, {'error': {'code': 613, 'message': 'Calls to this api have exceeded the rate limit'}})]
+
+    fb_messenger.send_message(SENDER_ID, {'text': 'hello'})
+    assert graph_server.requests_count == 2
+
+
+def test_failed_connection_is_retried(monkeypatch):
+    monkeypatch.setenv('GRAPH_API_URL', 'http://127.0.0.1:9/v2.6')
+    monkeypatch.setenv('MESSENGER_BACKOFF', '0')
+    monkeypatch.setenv('MESSENGER_RETRIES', '2')
+    monkeypatch.setattr(fb_messenger, '_session', None)
+    session = fb_messenger.get_session()
+    attempts = []
+
+    def post(*args, **kwargs):
+        attempts.append(args)
+        return requests.Session.post(session, *args, **kwargs)
+
+    monkeypatch.setattr(session, 'post', post)
+
+    with pytest.raises(requests.ConnectionError) as error_info:
+        fb_messenger.send_message(SENDER_ID, {'text': 'hello'})
+    assert fb_messenger.is_connect_error(error_info.value)
+    assert len(attempts) == 3
+
+
+def test_failed_reply_keeps_state(db, graph_server, graph_stub, moltin_server, monkeypatch):
+    monkeypatch.setattr(app, '_database', db)
+    state_key = redis_keys.get_fb_state_key(SENDER_ID)
+    db.set(state_key, 'CART')
+    graph_stub.failures = [(500, {'error': {'code': 2}})]
+
+    app.handle_users_reply(SENDER_ID, 'menu')
+    assert db.get(state_key) == b'CART'
+
+    app.handle_users_reply(SENDER_ID, 'menu')
+    assert db.get(state_key) == b'MENU'
+
+
+def get_batch_result(status, content):
+    return {'code': status, 'body': json.dumps(content)}
+
+
+def test_failed_batch_item_fails_the_turn(db, graph_server, graph_stub, moltin_server, moltin_stub, monkeypatch):
+    monkeypatch.setattr(app, '_database', db)
+    state_key = redis_keys.get_fb_state_key(SENDER_ID)
+    db.set(state_key, 'CART')
+    sent = get_batch_result(200, {'recipient_id': SENDER_ID, 'message_id': 'mid'})
+    failed = get_batch_result(400, {'error': {'code': 100, 'message': 'Invalid parameter'}})
+    graph_stub.failures = [(200, [sent, failed])]
+    add_to_cart = f'add_to_cart,{moltin_stub.products[0]["id"]}'
+
+    # The text and the cart after it are sent in one batch
+    app.handle_users_reply(SENDER_ID, add_to_cart)
+    assert len(graph_stub.get_batches()) == 1
+    # The state is saved with the session TTL, the state of the failed turn is not
+    assert db.ttl(state_key) == -1
+
+    app.handle_users_reply(SENDER_ID, add_to_cart)
+    assert db.ttl(state_key) > 0
+
+
+def test_rate_limited_batch_items_are_sent_again(graph_server, graph_stub):
+    sent = get_batch_result(200, {'recipient_id': 'user0', 'message_id': 'mid'})
+    rate_limited = get_batch_result(400, {'error': {'code': 613, 'message': 'Calls to this api have exceeded the rate limit'}})
+    # The second message of user0 depends on the rate limited one and is not run
+    graph_stub.failures = [(200, [rate_limited, sent, None])]
+
+    with fb_messenger.batch():
+        for message_number in range(3):
+            fb_messenger.send_message(f'user{message_number % 2}', {'text': str(message_number)})
+
+    first_batch, second_batch = graph_stub.get_batches()
+    assert len(first_batch) == 3
+    assert [parse_qs(batch_request['body'])['message'] for batch_request in second_batch] == [
+        ['{"text": "0"}'],
+        ['{"text": "2"}'],
+    ]
+    assert second_batch[1]['depends_on'] == second_batch[0]['name']
+
+
+def test_batch_items_rate_limited_for_long_fail_the_send(graph_server, graph_stub, monkeypatch):
+    monkeypatch.setenv('MESSENGER_RETRIES', '1')
+    rate_limited = get_batch_result(429, {'error': {'code': 4}})
+    sent = get_batch_result(200, {'recipient_id': 'user1', 'message_id': 'mid'})
+    graph_stub.failures = [(200, [rate_limited, sent]), (200, [rate_limited])]
+
+    with pytest.raises(fb_messenger.MessengerError):
+        with fb_messenger.batch():
+            fb_messenger.send_message('user0', {'text': '0'})
+            fb_messenger.send_message('user1', {'text': '1'})
+    assert graph_server.requests_count == 2
@@ -0,0 +1,111 @@
+import time
+
+import pytest
+from telegram import Update
+
+import fetch_coordinates
+import redis_keys
+import session_store
+import tg_pizza_bot
+from load_benchmark import StubServer, get_telegram_update, route_yandex
+
+CHAT_ID = 1001
+TELEGRAM_TOKEN = '123456:TEST'
+
+
+class StubGeocoder:
+    def __init__(self, places):
+        self.places = places
+        self.calls = []
+
+    def __call__(self, place, apikey):
+        self.calls.append(place)
+        return self.places.get(fetch_coordinates.normalize_address(place))
+
+
+@pytest.fixture(autouse=True)
+def local_cache(monkeypatch):
+    monkeypatch.setattr(fetch_coordinates, '_local_cache', fetch_coordinates.OrderedDict())
+    monkeypatch.setattr(fetch_coordinates, '_stats', dict.fromkeys(fetch_coordinates._stats, 0))
+
+
+@pytest.fixture
+def geocoder():
+    return StubGeocoder({
+        'москва ул тверская 1': ('37.61', '55.75'),
+        'москва ул арбат 2': ('37.59', '55.75'),
+        'москва ул ленина 3': ('37.62', '55.74'),
+    })
+
+
+def test_spellings_of_one_address_make_one_call(db, geocoder):
+    for place in ('Москва, ул. Тверская, 1', 'москва ул тверская 1', '  МОСКВА,  УЛ. ТВЕРСКАЯ 1!'):
+        assert fetch_coordinates.fetch_coordinates(place, 'key', db, geocoder) == ('37.61', '55.75')
+
+    assert len(geocoder.calls) == 1
+
+
+def test_other_process_reads_address_from_database(db, geocoder, monkeypatch):
+    fetch_coordinates.fetch_coordinates('Москва, ул. Тверская, 1', 'key', db, geocoder)
+    monkeypatch.setattr(fetch_coordinates, '_local_cache', fetch_coordinates.OrderedDict())
+
+    assert fetch_coordinates.fetch_coordinates('Москва, ул. Тверская, 1', 'key', db, geocoder) == ('37.61', '55.75')
+    assert len(geocoder.calls) == 1
+    assert fetch_coordinates.get_geocode_stats() == {'local_hits': 0, 'redis_hits': 1, 'misses': 1, 'not_found': 0}
+
+
+def test_address_not_found_is_cached_for_its_ttl(db, geocoder, monkeypatch):
+    monkeypatch.setenv('GEOCODE_NOT_FOUND_TTL', '1')
+
+    for __ in range(2):
+        with pytest.raises(IndexError):
+            fetch_coordinates.fetch_coordinates('Москва, нет такой улицы', 'key', db, geocoder)
+    assert len(geocoder.calls) == 1
+    assert db.ttl(redis_keys.get_geocode_key('москва нет такой улицы')) <= 1
+
+    time.sleep(1.1)
+    with pytest.raises(IndexError):
+        fetch_coordinates.fetch_coordinates('Москва, нет такой улицы', 'key', db, geocoder)
+    assert len(geocoder.calls) == 2
+    assert fetch_coordinates.get_geocode_stats()['not_found'] == 3
+
+
+def test_least_recently_used_address_is_evicted(geocoder, monkeypatch):
+    monkeypatch.setenv('GEOCODE_LRU_SIZE', '2')
+
+    for place in ('ул тверская 1', 'ул арбат 2', 'ул тверская 1', 'ул ленина 3'):
+        fetch_coordinates.fetch_coordinates(f'Москва, {place}', 'key', geocoder=geocoder)
+    assert list(fetch_coordinates._local_cache) == ['москва ул тверская 1', 'москва ул ленина 3']
+
+    fetch_coordinates.fetch_coordinates('Москва, ул тверская 1', 'key', geocoder=geocoder)
+    fetch_coordinates.fetch_coordinates('Москва, ул арбат 2', 'key', geocoder=geocoder)
+    assert geocoder.calls == ['Москва, ул тверская 1', 'Москва, ул арбат 2', 'Москва, ул ленина 3', 'Москва, ул арбат 2']
+
+
+def test_hits_and_misses_are_counted(db, geocoder):
+    fetch_coordinates.fetch_coordinates('Москва, ул тверская 1', 'key', db, geocoder)
+    fetch_coordinates.fetch_coordinates('Москва, ул тверская 1', 'key', db, geocoder)
+    fetch_coordinates.fetch_coordinates('Москва, ул арбат 2', 'key', db, geocoder)
+    with pytest.raises(IndexError):
+        fetch_coordinates.fetch_coordinates('Москва, нет такой улицы', 'key', db, geocoder)
+    with pytest.raises(IndexError):
+        fetch_coordinates.fetch_coordinates('Москва, нет такой улицы', 'key', db, geocoder)
+
+    assert fetch_coordinates.get_geocode_stats() == {'local_hits': 2, 'redis_hits': 0, 'misses': 3, 'not_found': 2}
+
+
+def test_slow_geocoder_asks_for_address_again(db, moltin_server, telegram_server, monkeypatch):
+    yandex_server = StubServer('yandex', route_yandex, latency=0.5)
+    monkeypatch.setenv('YANDEX_GEOCODER_URL', yandex_server.url)
+    monkeypatch.setenv('YANDEX_TIMEOUT', '0.1')
+    monkeypatch.setattr(tg_pizza_bot, '_database', db)
+    updater = tg_pizza_bot.create_updater(TELEGRAM_TOKEN)
+    session_store.save_session(db, CHAT_ID, {'state': 'HANDLE_LOCATION', 'cart': {'items': [], 'total_amount': 0}})
+    telegram_requests_count = telegram_server.requests_count
+
+    update_content = get_telegram_update(CHAT_ID, text='Москва, ул. Тверская, 1')
+    updater.dispatcher.process_update(Update.de_json(update_content, updater.bot))
+    yandex_server.close()
+
+    assert session_store.load_session(db, CHAT_ID)['state'] == 'HANDLE_LOCATION'
+    assert telegram_server.requests_count == telegram_requests_count + 1
@@ -0,0 +1,119 @@
+import json
+
+import pytest
+
+import migrate_redis_keys
+import redis_keys
+import serializer
+import session_store
+
+# SCAN of fakeredis skips keys when keys are deleted between its calls,
+# so every test reads all the keys with one call
+BATCH_SIZE = 1000
+SESSION_TTL = 30 * 24 * 60 * 60
+
+CART = {'items': [{'product_id': 'product-1', 'quantity': 2}], 'total_amount': 600}
+PIZZERIA = {'alias': 'mira', 'address': 'Москва, проспект Мира, 11', 'deliveryman-chat-id': 1}
+
+
+@pytest.fixture
+def legacy_db(db):
+    db.set('123', 'HANDLE_DELIVERY')
+    db.set('123_cart', json.dumps(CART))
+    db.set('123_pizzeria', json.dumps(PIZZERIA))
+    # Chats of Telegram groups have negative ids
+    db.set('-456', 'HANDLE_MENU')
+    db.set('fb_789', 'CART')
+    for key in redis_keys.LEGACY_SHARED_KEYS:
+        db.set(key, '{}')
+    return db
+
+
+def get_snapshot(db):
+    return {key: (db.type(key), db.dump(key), db.ttl(key)) for key in db.keys()}
+
+
+def test_telegram_keys_move_to_session(legacy_db):
+    stats = migrate_redis_keys.migrate(legacy_db, BATCH_SIZE)
+
+    assert session_store.load_session(legacy_db, 123) == {
+        'state': 'HANDLE_DELIVERY',
+        'cart': CART,
+        'pizzeria': PIZZERIA,
+    }
+    assert session_store.load_session(legacy_db, -456) == {'state': 'HANDLE_MENU'}
+    assert 0 < legacy_db.ttl(redis_keys.get_tg_session_key(123)) <= SESSION_TTL
+    assert 0 < legacy_db.ttl(redis_keys.get_tg_session_key(-456)) <= SESSION_TTL
+    assert not legacy_db.exists('123', '123_cart', '123_pizzeria', '-456')
+    assert (stats['tg state'], stats['tg cart'], stats['tg pizzeria']) == (2, 1, 1)
+
+
+def test_messenger_state_moves_to_namespace(legacy_db):
+    stats = migrate_redis_keys.migrate(legacy_db, BATCH_SIZE)
+
+    assert legacy_db.get(redis_keys.get_fb_state_key('789')) == b'CART'
+    assert 0 < legacy_db.ttl(redis_keys.get_fb_state_key('789')) <= SESSION_TTL
+    assert not legacy_db.exists('fb_789')
+    assert stats['fb state'] == 1
+
+
+def test_legacy_shared_keys_are_deleted(legacy_db):
+    legacy_db.set(redis_keys.CATALOG_VERSION_KEY, 'v1')
+
+    stats = migrate_redis_keys.migrate(legacy_db, BATCH_SIZE)
+
+    assert not legacy_db.exists(*redis_keys.LEGACY_SHARED_KEYS)
+    assert legacy_db.get(redis_keys.CATALOG_VERSION_KEY) == b'v1'
+    assert stats['legacy shared'] == len(redis_keys.LEGACY_SHARED_KEYS)
+
+
+def test_keys_of_new_layout_get_expiry(db, monkeypatch):
+    monkeypatch.setenv('CART_MIRROR_TTL', '3600')
+    db.set(redis_keys.get_cart_key('fb_789'), serializer.dumps(CART, 'cart'))
+    db.set(redis_keys.get_fb_state_key('789'), 'MENU')
+    session_store.save_session(db, 123, {'state': 'START'})
+    db.persist(redis_keys.get_tg_session_key(123))
+    db.set(redis_keys.get_cart_key('123'), serializer.dumps(CART, 'cart'), ex=100)
+    db.set(redis_keys.get_fb_event_key('mid'), 1)
+
+    stats = migrate_redis_keys.migrate(db, BATCH_SIZE)
+
+    assert 3500 < db.ttl(redis_keys.get_cart_key('fb_789')) <= 3600
+    assert 0 < db.ttl(redis_keys.get_fb_state_key('789')) <= SESSION_TTL
+    assert 0 < db.ttl(redis_keys.get_tg_session_key(123)) <= SESSION_TTL
+    # A key that already expires keeps its expiry, keys of other namespaces are not touched
+    assert db.ttl(redis_keys.get_cart_key('123')) <= 100
+    assert db.ttl(redis_keys.get_fb_event_key('mid')) == -1
+    assert stats['expiry added'] == 3
+
+
+def test_dry_run_changes_nothing(legacy_db):
+    legacy_db.set(redis_keys.get_cart_key('fb_789'), serializer.dumps(CART, 'cart'))
+    snapshot = get_snapshot(legacy_db)
+
+    dry_run_stats = migrate_redis_keys.migrate(legacy_db, BATCH_SIZE, dry_run=True)
+
+    assert get_snapshot(legacy_db) == snapshot
+    assert migrate_redis_keys.migrate(legacy_db, BATCH_SIZE) == dry_run_stats
+
+
+def test_second_run_changes_nothing(legacy_db):
+    migrate_redis_keys.migrate(legacy_db, BATCH_SIZE)
+    snapshot = get_snapshot(legacy_db)
+
+    stats = migrate_redis_keys.migrate(legacy_db, BATCH_SIZE)
+
+    assert get_snapshot(legacy_db) == snapshot
+    assert dict(stats) == {'scanned': len(snapshot)}
+
+
+def test_newer_session_is_not_overwritten(legacy_db):
+    # The bot has answered the user since the first run was stopped
+    session_store.save_session(legacy_db, 123, {'state': 'HANDLE_MENU'})
+
+    migrate_redis_keys.migrate(legacy_db, BATCH_SIZE)
+
+    session = session_store.load_session(legacy_db, 123)
+    assert session['state'] == 'HANDLE_MENU'
+    assert session['cart'] == CART
+    assert not legacy_db.exists('123')
@@ -0,0 +1,106 @@
+import time
+
+import pytest
+import requests
+
+import moltin
+from load_benchmark import StubServer
+
+# A turn of the bots makes about this many moltin calls
+TURN_CALLS = 5
+
+
+def test_calls_share_one_connection(moltin_server):
+    for __ in range(TURN_CALLS):
+        moltin.call_api('GET', '/v2/categories')
+
+    assert moltin_server.requests_count == TURN_CALLS
+    assert moltin_server.connections_count == 1
+
+
+def test_pooled_session_cuts_turn_latency(moltin_stub, monkeypatch):
+    # Every new connection costs 50 ms, as the handshakes with a distant https service
+    server = StubServer('moltin', moltin_stub.route, latency=0.005, connect_latency=0.05)
+    monkeypatch.setenv('MOLTIN_API_URL', server.url)
+    monkeypatch.setattr(moltin, '_session', None)
+    monkeypatch.setattr(moltin, '_breaker', None)
+    try:
+        started_at = time.monotonic()
+        for __ in range(TURN_CALLS):
+            requests.get(f'{server.url}/v2/categories').raise_for_status()
+        unpooled_turn = time.monotonic() - started_at
+
+        moltin.call_api('GET', '/v2/categories')
+        started_at = time.monotonic()
+        for __ in range(TURN_CALLS):
+            moltin.call_api('GET', '/v2/categories')
+        pooled_turn = time.monotonic() - started_at
+    finally:
+        server.close()
+
+    print(f'\nturn of {TURN_CALLS} moltin calls: {unpooled_turn * 1000:.0f} ms with a connection per call, '
+          f'{pooled_turn * 1000:.0f} ms with the pooled session')
+    assert server.connections_count == TURN_CALLS + 1
+    assert pooled_turn < unpooled_turn / 3
+
+
+@pytest.fixture
+def failing_moltin(moltin_server, moltin_stub, monkeypatch):
+    monkeypatch.setenv('MOLTIN_RETRIES', '3')
+    monkeypatch.setenv('MOLTIN_BACKOFF', '0')
+    monkeypatch.setenv('MOLTIN_BREAKER_FAILURES', '5')
+    monkeypatch.setenv('MOLTIN_BREAKER_RESET_TIMEOUT', '0.2')
+    moltin_stub.error_rate = 1
+    return moltin_server
+
+
+def test_every_attempt_counts_for_the_breaker(failing_moltin):
+    with pytest.raises(moltin.MoltinUnavailable):
+        moltin.call_api('GET', '/v2/categories')
+    assert failing_moltin.requests_count == 4
+
+    # The fifth failed attempt opens the circuit in the middle of the retries
+    with pytest.raises(moltin.MoltinUnavailable, match='circuit is open'):
+        moltin.call_api('GET', '/v2/categories')
+    assert failing_moltin.requests_count == 5
+
+
+def test_open_circuit_short_circuits_calls(failing_moltin, moltin_stub):
+    failing_moltin.latency = 0.1
+    for __ in range(2):
+        with pytest.raises(moltin.MoltinUnavailable):
+            moltin.call_api('GET', '/v2/categories')
+    requests_count = failing_moltin.requests_count
+
+    started_at = time.monotonic()
+    for __ in range(20):
+        with pytest.raises(moltin.MoltinUnavailable, match='circuit is open'):
+            moltin.call_api('GET', '/v2/categories')
+    assert time.monotonic() - started_at < 0.05
+    assert failing_moltin.requests_count == requests_count
+
+    # After the reset timeout one probe finds moltin back and closes the circuit
+    time.sleep(0.2)
+    moltin_stub.error_rate = 0
+    moltin.call_api('GET', '/v2/categories')
+    moltin.call_api('GET', '/v2/categories')
+    assert failing_moltin.requests_count == requests_count + 2
+
+
+def test_retries_stop_at_the_deadline(failing_moltin, monkeypatch):
+    monkeypatch.setenv('MOLTIN_RETRIES', '10')
+    monkeypatch.setenv('MOLTIN_BREAKER_FAILURES', '100')
+    monkeypatch.setenv('MOLTIN_DEADLINE', '0.5')
+    failing_moltin.latency = 0.2
+
+    started_at = time.monotonic()
+    with pytest.raises(moltin.MoltinUnavailable):
+        moltin.call_api('GET', '/v2/categories')
+    assert time.monotonic() - started_at < 0.7
+    assert failing_moltin.requests_count <= 3
+
+
+def test_failed_post_is_not_sent_again(failing_moltin):
+    with pytest.raises(moltin.MoltinUnavailable):
+        moltin.call_api('POST', '/v2/carts/1001/items', data='{}')
+    assert failing_moltin.requests_count == 1
@@ -0,0 +1,59 @@
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import moltin_token
+import redis_keys
+
+WORKERS = 8
+
+
+@pytest.fixture
+def moltin_paths(moltin_server):
+    paths = Counter()
+    route = moltin_server.route
+
+    def count_route(method, path, query, body):
+        paths[path] += 1
+        return route(method, path, query, body)
+
+    moltin_server.route = count_route
+    return paths
+
+
+def test_token_is_refreshed_once(db, moltin_server, moltin_paths):
+    moltin_server.latency = 0.05
+
+    # Each call stands for a process of its own, only the database lock is shared
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        tokens = list(executor.map(lambda __: moltin_token.refresh_token(db), range(WORKERS)))
+
+    assert moltin_paths['/oauth/access_token'] == 1
+    assert len({token['token'] for token in tokens}) == 1
+    assert not db.exists(redis_keys.TOKEN_LOCK_KEY)
+
+
+def test_threads_of_a_process_share_its_token(db, moltin_server, moltin_paths):
+    moltin_server.latency = 0.05
+
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        tokens = list(executor.map(lambda __: moltin_token.get_token(db), range(WORKERS)))
+
+    assert moltin_paths['/oauth/access_token'] == 1
+    assert set(tokens) == {'benchmark'}
+
+
+def test_token_is_requested_when_lock_wait_times_out(db, moltin_server, moltin_paths, monkeypatch):
+    monkeypatch.setenv('MOLTIN_TOKEN_LOCK_TIMEOUT', '1')
+    # The process that took the lock has hung
+    db.set(redis_keys.TOKEN_LOCK_KEY, 'other process', ex=60)
+
+    started_at = time.monotonic()
+    token = moltin_token.refresh_token(db)
+
+    assert 0.5 < time.monotonic() - started_at < 5
+    assert token['token'] == 'benchmark'
+    assert moltin_paths['/oauth/access_token'] == 1
+    assert moltin_token.get_shared_token(db) == token
@@ -0,0 +1,97 @@
+import pytest
+
+import moltin
+from load_benchmark import StubServer
+
+PAGE_LIMIT = 5
+
+
+class PagedProductsStub:
+    def __init__(self, products_count, last_page_links='none'):
+        self.products = [
+            {
+                'id': f'product-{number}',
+                'name': f'Пицца {number}',
+                'description': f'Описание пиццы {number}',
+                'meta': {'display_price': {'with_tax': {'formatted': '300'}}},
+                'relationships': {'main_image': {'data': {'id': f'image-{number}'}}},
+            }
+            for number in range(products_count)
+        ]
+        # How the last page links on: 'none', 'current' or 'empty' page after it
+        self.last_page_links = last_page_links
+        self.url = None
+        self.offsets = []
+
+    def get_page_url(self, limit, offset):
+        return f'{self.url}/v2/products?page[limit]={limit}&page[offset]={offset}'
+
+    def route(self, method, path, query, body):
+        limit = int(query['page[limit]'][0])
+        offset = int(query.get('page[offset]', ['0'])[0])
+        self.offsets.append(offset)
+
+        next_offset = offset + limit
+        if next_offset < len(self.products):
+            next_url = self.get_page_url(limit, next_offset)
+        elif self.last_page_links == 'current':
+            next_url = self.get_page_url(limit, offset)
+        elif self.last_page_links == 'empty' and offset < len(self.products):
+            next_url = self.get_page_url(limit, next_offset)
+        else:
+            next_url = None
+        return 200, {
+            'data': self.products[offset:next_offset],
+            'links': {'current': self.get_page_url(limit, offset), 'next': next_url},
+            'meta': {'results': {'total': len(self.products)}},
+        }
+
+
+@pytest.fixture
+def serve_products(monkeypatch):
+    servers = []
+
+    def serve(products_count, last_page_links='none'):
+        stub = PagedProductsStub(products_count, last_page_links)
+        server = StubServer('moltin', stub.route, latency=0)
+        stub.url = server.url
+        servers.append(server)
+        monkeypatch.setenv('MOLTIN_API_URL', server.url)
+        return stub
+
+    monkeypatch.setenv('MOLTIN_PAGE_LIMIT', str(PAGE_LIMIT))
+    monkeypatch.setattr(moltin, '_session', None)
+    monkeypatch.setattr(moltin, '_breaker', None)
+    yield serve
+    for server in servers:
+        server.close()
+
+
+@pytest.mark.parametrize('products_count, offsets', [
+    (0, [0]),
+    (3, [0]),
+    (PAGE_LIMIT, [0]),
+    (PAGE_LIMIT * 2, [0, 5]),
+    (PAGE_LIMIT * 2 + 1, [0, 5, 10]),
+])
+def test_every_product_is_read_once(serve_products, products_count, offsets):
+    stub = serve_products(products_count)
+
+    products = moltin.get_products_list('token')
+
+    assert [product['id'] for product in products] == [product['id'] for product in stub.products]
+    assert stub.offsets == offsets
+
+
+def test_last_page_linking_to_itself_ends_reading(serve_products):
+    stub = serve_products(PAGE_LIMIT + 2, last_page_links='current')
+
+    assert len(moltin.get_products_list('token')) == PAGE_LIMIT + 2
+    assert stub.offsets == [0, 5]
+
+
+def test_empty_page_ends_reading(serve_products):
+    stub = serve_products(PAGE_LIMIT * 2, last_page_links='empty')
+
+    assert len(moltin.get_products_list('token')) == PAGE_LIMIT * 2
+    assert stub.offsets == [0, 5, 10]
@@ -0,0 +1,124 @@
+import json
+import time
+import uuid
+
+import pytest
+
+import serializer
+from load_benchmark import CATEGORIES, MoltinStub
+
+ITERATIONS = 200
+
+
+def get_realistic_catalog(moltin_stub):
+    ids = {product['id']: str(uuid.uuid4()) for product in moltin_stub.products}
+    products = [
+        {
+            'name': product['name'],
+            'id': ids[product['id']],
+            'description': f'{product["description"]}: моцарелла, томаты, фирменный томатный соус',
+            'price': str(product['price']),
+            'image_id': str(uuid.uuid4()),
+            'image_url': f'https://files-eu.epusercontent.com/{uuid.uuid4()}/{uuid.uuid4()}.jpg',
+        }
+        for product in moltin_stub.products
+    ]
+    categories = {category: str(uuid.uuid4()) for category in CATEGORIES}
+    products_by_categories = {
+        category: [ids[product['id']] for product in moltin_stub.products if product['category'] == category]
+        for category in CATEGORIES
+    }
+    pizzerias = [
+        dict(pizzeria, id=str(uuid.uuid4()), alias=pizzeria['id'], latitude=str(pizzeria['latitude']),
+             longitude=str(pizzeria['longitude']), type='entry')
+        for pizzeria in moltin_stub.pizzerias
+    ]
+    return {
+        'products': products,
+        'categories': categories,
+        'products_by_categories': products_by_categories,
+        'pizzerias': pizzerias,
+    }
+
+
+def get_cart(menu_catalog):
+    return {
+        'items': [
+            dict(product, product_id=product['id'], id=str(uuid.uuid4()), quantity=2, amount=product['price'])
+            for product in menu_catalog['products'][:3]
+        ],
+        'total_amount': 1200,
+    }
+
+
+def measure(function):
+    started_at = time.perf_counter()
+    for __ in range(ITERATIONS):
+        function()
+    return (time.perf_counter() - started_at) / ITERATIONS
+
+
+@pytest.fixture(scope='module')
+def menu_catalog():
+    return get_realistic_catalog(MoltinStub(30, 100))
+
+
+@pytest.mark.parametrize('serializer_format', ['json', 'msgpack'])
+def test_blob_is_read_back(menu_catalog, serializer_format, monkeypatch):
+    if serializer_format == 'msgpack' and not serializer.msgpack:
+        pytest.skip('msgpack is not installed')
+    monkeypatch.setenv('SERIALIZER', serializer_format)
+
+    for schema, value in (('catalog', menu_catalog), ('cart', get_cart(menu_catalog))):
+        assert serializer.loads(serializer.dumps(value, schema), schema) == value
+
+
+def test_legacy_json_is_read(menu_catalog):
+    cart = get_cart(menu_catalog)
+
+    assert serializer.loads(json.dumps(cart).encode('utf-8'), 'cart') == cart
+    assert serializer.loads(json.dumps(cart), 'cart') == cart
+
+
+def test_blob_of_other_schema_is_refused(menu_catalog, monkeypatch):
+    monkeypatch.setenv('SERIALIZER', 'json')
+    blob = serializer.dumps(get_cart(menu_catalog), 'cart')
+
+    with pytest.raises(ValueError, match='schema cart'):
+        serializer.loads(blob, 'catalog')
+
+
+def test_newer_format_version_is_refused(menu_catalog, monkeypatch):
+    monkeypatch.setenv('SERIALIZER', 'json')
+    blob = bytearray(serializer.dumps(get_cart(menu_catalog), 'cart'))
+    blob[1] = serializer.FORMAT_VERSION + 1
+
+    with pytest.raises(ValueError, match='newer'):
+        serializer.loads(bytes(blob), 'cart')
+
+
+def test_serializers_size_and_speed(menu_catalog, monkeypatch):
+    variants = {'legacy json': None, 'json': 'json'}
+    if serializer.msgpack:
+        variants['msgpack'] = 'msgpack'
+
+    sizes = {}
+    for schema, value in (('catalog', menu_catalog), ('cart', get_cart(menu_catalog))):
+        print(f'\n{schema}:', end='')
+        for name, serializer_format in variants.items():
+            if serializer_format:
+                monkeypatch.setenv('SERIALIZER', serializer_format)
+                encode = lambda: serializer.dumps(value, schema)
+            else:
+                encode = lambda: json.dumps(value).encode('utf-8')
+            blob = encode()
+            encode_time = measure(encode)
+            decode_time = measure(lambda: serializer.loads(blob, schema))
+            sizes[schema, name] = len(blob)
+            print(f'\n  {name}: {len(blob)} bytes, encode {encode_time * 10 ** 6:.0f} us, '
+                  f'decode {decode_time * 10 ** 6:.0f} us', end='')
+
+    for schema in ('catalog', 'cart'):
+        assert sizes[schema, 'json'] < sizes[schema, 'legacy json']
+        if serializer.msgpack:
+            assert sizes[schema, 'msgpack'] < sizes[schema, 'json']
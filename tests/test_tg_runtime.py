@@ -0,0 +1,127 @@
+import asyncio
+import json
+import time
+from threading import Lock
+
+import pytest
+
+import catalog
+import tg_async_runtime
+import tg_pizza_bot
+from load_benchmark import StubServer, get_telegram_update, route_telegram
+from moltin_token import get_token
+
+TELEGRAM_TOKEN = '123456:TEST'
+CHATS_COUNT = 8
+UPDATES_PER_CHAT = 8
+
+
+class TelegramUpdatesStub:
+    def __init__(self, updates):
+        self.updates = updates
+
+    def route(self, method, path, query, body):
+        if path.rsplit('/', 1)[-1] != 'getUpdates':
+            return route_telegram(method, path, query, body)
+        parameters = json.loads(body) if body else {key: values[0] for key, values in query.items()}
+        offset = int(parameters.get('offset', 0))
+        pending = [update for update in self.updates if update['update_id'] >= offset]
+        if not pending:
+            time.sleep(0.05)
+        return 200, {'ok': True, 'result': pending[:100]}
+
+
+def get_updates():
+    updates = []
+    for update_number in range(UPDATES_PER_CHAT):
+        for chat_number in range(CHATS_COUNT):
+            update = get_telegram_update(3000 + chat_number, text='/start')
+            update['update_id'] = len(updates) + 1
+            updates.append(update)
+    return updates
+
+
+@pytest.fixture
+def updates_server(monkeypatch):
+    stub = TelegramUpdatesStub(get_updates())
+    # Every reply to Telegram takes 30 ms
+    server = StubServer('telegram', stub.route, latency=0.03)
+    monkeypatch.setenv('TELEGRAM_API_URL', server.url)
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def updater(db, moltin_server, updates_server, monkeypatch):
+    monkeypatch.setattr(tg_pizza_bot, '_database', db)
+    monkeypatch.setenv('TELEGRAM_CONCURRENCY', '16')
+    catalog.get_catalog(db, get_token(db))
+    return tg_pizza_bot.create_updater(TELEGRAM_TOKEN)
+
+
+def record_processed_updates(dispatcher):
+    processed = {}
+    lock = Lock()
+    process_update = dispatcher.process_update
+
+    def record_update(update):
+        process_update(update)
+        with lock:
+            processed.setdefault(update.effective_chat.id, []).append(update.update_id)
+
+    dispatcher.process_update = record_update
+    return processed
+
+
+def count_processed(processed):
+    return sum(len(update_ids) for update_ids in processed.values())
+
+
+def wait_for_updates(processed, timeout=30):
+    deadline = time.monotonic() + timeout
+    while count_processed(processed) < CHATS_COUNT * UPDATES_PER_CHAT and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def run_threaded_polling(updater):
+    processed = record_processed_updates(updater.dispatcher)
+    started_at = time.monotonic()
+    updater.start_polling(poll_interval=0, timeout=1)
+    try:
+        wait_for_updates(processed)
+        return processed, time.monotonic() - started_at
+    finally:
+        updater.stop()
+        del updater.dispatcher.process_update
+
+
+async def poll_until_processed(dispatcher, processed):
+    polling = asyncio.ensure_future(tg_async_runtime.poll_updates(dispatcher))
+    deadline = time.monotonic() + 30
+    while count_processed(processed) < CHATS_COUNT * UPDATES_PER_CHAT and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    polling.cancel()
+
+
+def run_asyncio_polling(updater):
+    processed = record_processed_updates(updater.dispatcher)
+    started_at = time.monotonic()
+    try:
+        asyncio.run(poll_until_processed(updater.dispatcher, processed))
+        return processed, time.monotonic() - started_at
+    finally:
+        del updater.dispatcher.process_update
+
+
+def test_asyncio_runtime_against_threaded_polling(updater):
+    threaded_processed, threaded_time = run_threaded_polling(updater)
+    asyncio_processed, asyncio_time = run_asyncio_polling(updater)
+
+    updates_count = CHATS_COUNT * UPDATES_PER_CHAT
+    print(f'\n{updates_count} updates of {CHATS_COUNT} chats: '
+          f'{updates_count / threaded_time:.0f} updates/s with threaded polling, '
+          f'{updates_count / asyncio_time:.0f} updates/s with the asyncio runtime')
+    for processed in (threaded_processed, asyncio_processed):
+        assert count_processed(processed) == updates_count
+        assert all(update_ids == sorted(update_ids) for update_ids in processed.values())
+    assert asyncio_time * 2 < threaded_time
@@ -0,0 +1,103 @@
+import pytest
+from telegram import Update
+
+import catalog
+import profiling
+import session_store
+import tg_pizza_bot
+from load_benchmark import get_telegram_update
+from moltin_token import get_token
+
+TELEGRAM_TOKEN = '123456:TEST'
+CHAT_ID = 1001
+CART = {'items': [], 'total_amount': 0}
+PIZZERIA = {'address': 'Москва, улица 1', 'latitude': '55.5', 'longitude': '37.3'}
+
+# Reads and writes of the user state, cart and pizzeria in a turn of the first
+# version of tg_pizza_bot.py, one database round trip each
+LEGACY_SESSION_CALLS = {
+    'HANDLE_CART': ['get state', 'set cart', 'set state'],
+    'HANDLE_LOCATION': ['get state', 'get cart', 'set cart', 'set pizzeria', 'set state'],
+    'HANDLE_DELIVERY': ['get state', 'get cart', 'get pizzeria', 'set cart', 'set state'],
+    'HANDLE_PAYMENT': ['get state', 'get cart', 'set state'],
+}
+
+
+@pytest.fixture
+def updater(db, moltin_server, telegram_server, yandex_server, monkeypatch):
+    monkeypatch.setattr(tg_pizza_bot, '_database', db)
+    catalog.get_catalog(db, get_token(db))
+    return tg_pizza_bot.create_updater(TELEGRAM_TOKEN)
+
+
+def count_redis_calls(channel):
+    metric_key = profiling.get_metric_key('bot_turn_dependency_calls_total',
+                                          {'channel': channel, 'dependency': 'redis'})
+    return profiling.get_counters().get(metric_key, 0)
+
+
+def send_update(updater, update_content):
+    updater.dispatcher.process_update(Update.de_json(update_content, updater.bot))
+
+
+def replay_legacy_session_calls(db, calls):
+    keys = {'state': CHAT_ID, 'cart': f'{CHAT_ID}_cart', 'pizzeria': f'{CHAT_ID}_pizzeria'}
+    with profiling.turn('legacy'):
+        for call in calls:
+            command, field = call.split()
+            if command == 'get':
+                db.get(keys[field])
+            else:
+                db.set(keys[field], 'value')
+
+
+def test_session_round_trips_per_turn(db, updater, moltin_stub):
+    product_id = moltin_stub.products[0]['id']
+    steps = [
+        ('START', get_telegram_update(CHAT_ID, text='/start')),
+        ('HANDLE_MENU', get_telegram_update(CHAT_ID, data=product_id)),
+        ('HANDLE_DESCRIPTION', get_telegram_update(CHAT_ID, data=product_id)),
+        ('HANDLE_CART', get_telegram_update(CHAT_ID, data='cart')),
+        ('HANDLE_WAITING', get_telegram_update(CHAT_ID, data='delivery_choice')),
+        ('HANDLE_LOCATION', get_telegram_update(CHAT_ID, text='Москва, Тверская улица, 1')),
+        ('HANDLE_DELIVERY', get_telegram_update(CHAT_ID, data='delivery')),
+        ('HANDLE_PAYMENT', get_telegram_update(CHAT_ID, data='cash')),
+    ]
+    for state, update_content in steps:
+        turn_calls = count_redis_calls('telegram')
+        send_update(updater, update_content)
+        turn_calls = count_redis_calls('telegram') - turn_calls
+
+        session_calls = count_redis_calls('session')
+        with profiling.turn('session'):
+            session = session_store.load_session(db, CHAT_ID)
+            session_store.save_session(db, CHAT_ID, session)
+        session_calls = count_redis_calls('session') - session_calls
+        assert session_calls == 2
+
+        if state in LEGACY_SESSION_CALLS:
+            legacy_calls = count_redis_calls('legacy')
+            replay_legacy_session_calls(db, LEGACY_SESSION_CALLS[state])
+            legacy_calls = count_redis_calls('legacy') - legacy_calls
+            assert legacy_calls >= 3
+            print(f'\n{state}: {turn_calls} round trips in the turn, session {session_calls}, '
+                  f'before the session hash {legacy_calls}', end='')
+
+    assert session_store.load_session(db, CHAT_ID)['state'] == 'HANDLE_DELIVERYMAN'
+
+
+def test_unknown_recorded_state_starts_over(db, updater):
+    session_store.save_session(db, CHAT_ID, {'state': None})
+
+    send_update(updater, get_telegram_update(CHAT_ID, text='hello'))
+
+    assert session_store.load_session(db, CHAT_ID)['state'] == 'START'
+
+
+def test_unhandled_reply_keeps_state(db, updater):
+    session_store.save_session(db, CHAT_ID, {'state': 'HANDLE_PAYMENT', 'cart': CART, 'pizzeria': PIZZERIA})
+
+    send_update(updater, get_telegram_update(CHAT_ID, data='unknown'))
+    send_update(updater, get_telegram_update(CHAT_ID, data='unknown'))
+
+    assert session_store.load_session(db, CHAT_ID)['state'] == 'HANDLE_PAYMENT'
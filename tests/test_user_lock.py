@@ -0,0 +1,116 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
+
+import pytest
+
+import app
+import redis_keys
+import user_lock
+import webhook_worker
+from load_benchmark import get_messenger_event
+
+USER = 'tg_1001'
+TURNS_PER_WORKER = 20
+
+
+def test_two_workers_lose_no_transition(db):
+    counter_key = 'turns'
+
+    def run_turns(worker):
+        for __ in range(TURNS_PER_WORKER):
+            with user_lock.hold_lock(db, USER):
+                turns = int(db.get(counter_key) or 0)
+                time.sleep(0.001)
+                db.set(counter_key, turns + 1)
+
+    with ThreadPoolExecutor(2) as executor:
+        list(executor.map(run_turns, range(2)))
+
+    assert int(db.get(counter_key)) == TURNS_PER_WORKER * 2
+
+
+def test_slow_turn_keeps_its_lock(db, monkeypatch):
+    monkeypatch.setenv('USER_LOCK_TIMEOUT', '1')
+    lock_key = redis_keys.get_lock_key(USER)
+
+    with user_lock.hold_lock(db, USER):
+        time.sleep(2.5)
+        assert db.exists(lock_key)
+        with pytest.raises(user_lock.UserBusy):
+            with user_lock.hold_lock(db, USER):
+                pass
+    assert not db.exists(lock_key)
+
+
+def test_busy_user_gets_the_event_back(db, graph_server, graph_stub, moltin_server, monkeypatch):
+    monkeypatch.setenv('USER_LOCK_TIMEOUT', '1')
+    monkeypatch.setattr(app, '_database', db)
+    client = app.app.test_client()
+    event = get_messenger_event('2001', message='menu')
+    turn_started, turn_finished = Event(), Event()
+
+    def hold_turn():
+        with user_lock.hold_lock(db, 'fb_2001'):
+            turn_started.set()
+            turn_finished.wait()
+
+    with ThreadPoolExecutor(1) as executor:
+        executor.submit(hold_turn)
+        turn_started.wait()
+        response = client.post('/', data=json.dumps(event), content_type='application/json')
+        turn_finished.set()
+    assert response.status_code == 503
+    assert not graph_stub.requests
+
+    # Facebook delivers it again and it is not taken for a duplicate
+    response = client.post('/', data=json.dumps(event), content_type='application/json')
+    assert response.status_code == 200
+    assert graph_stub.requests
+
+
+def test_busy_user_is_sent_back_before_facebook_gives_up(db, graph_server, graph_stub, moltin_server, monkeypatch):
+    monkeypatch.setattr(app, '_database', db)
+    client = app.app.test_client()
+    event = get_messenger_event('2001', message='menu')
+    turn_started, turn_finished = Event(), Event()
+
+    def hold_turn():
+        with user_lock.hold_lock(db, 'fb_2001'):
+            turn_started.set()
+            turn_finished.wait()
+
+    with ThreadPoolExecutor(1) as executor:
+        executor.submit(hold_turn)
+        turn_started.wait()
+        started_at = time.monotonic()
+        response = client.post('/', data=json.dumps(event), content_type='application/json')
+        waited = time.monotonic() - started_at
+        turn_finished.set()
+
+    assert response.status_code == 503
+    # Facebook waits 20 seconds for an answer, gunicorn gives a request 30
+    assert waited < 10
+    assert not db.exists(redis_keys.get_fb_event_key(event['entry'][0]['messaging'][0]['message']['mid']))
+
+
+def test_worker_queues_busy_event_again(db):
+    queue_key = webhook_worker.get_queue_key('2001')
+    for step in range(3):
+        webhook_worker.enqueue_event(db, '2001', f'step,{step}')
+    busy_errors = [user_lock.UserBusy('Previous reply of fb_2001 is still handled')]
+    handled_steps = []
+    all_handled = Event()
+
+    def handle_event(event):
+        if busy_errors:
+            raise busy_errors.pop()
+        handled_steps.append(event['message'])
+        if len(handled_steps) == 3:
+            all_handled.set()
+
+    Thread(target=webhook_worker.drain_queue, args=(db, queue_key, handle_event), daemon=True).start()
+
+    assert all_handled.wait(5)
+    assert handled_steps == ['step,0', 'step,1', 'step,2']
@@ -0,0 +1,131 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier
+
+import pytest
+
+import app
+import catalog
+import redis_keys
+import session_store
+import tg_pizza_bot
+import webhook_worker
+from load_benchmark import get_messenger_event, get_percentile, get_telegram_update
+from moltin_token import get_token
+
+SENDERS_COUNT = 10
+EVENTS_PER_SENDER = 20
+TELEGRAM_TOKEN = '123456:TEST'
+CHAT_ID = 1001
+
+
+@pytest.fixture
+def client(db, monkeypatch):
+    monkeypatch.setattr(app, '_database', db)
+    return app.app.test_client()
+
+
+@pytest.fixture
+def telegram_updater(monkeypatch):
+    monkeypatch.setattr(app, '_telegram_updater', None)
+    yield
+    if app._telegram_updater:
+        app._telegram_updater.job_queue.stop()
+
+
+def test_async_webhook_answers_before_moltin(client, db, moltin_server, monkeypatch):
+    monkeypatch.setenv('ASYNC_WEBHOOK', 'true')
+    monkeypatch.setenv('WEBHOOK_QUEUE_SHARDS', '4')
+    moltin_server.latency = 0.3
+
+    durations = []
+    for event_number in range(EVENTS_PER_SENDER):
+        for sender_number in range(SENDERS_COUNT):
+            event = get_messenger_event(f'sender{sender_number}', postback=f'step,{event_number}')
+            started_at = time.monotonic()
+            response = client.post('/', data=json.dumps(event), content_type='application/json')
+            durations.append(time.monotonic() - started_at)
+            assert response.status_code == 200
+
+    p99 = get_percentile(durations, 99)
+    print(f'\nwebhook p99 {p99 * 1000:.1f} ms with moltin answering in 300 ms')
+    assert p99 < 0.1
+    assert moltin_server.requests_count == 0
+
+    queued_steps = {}
+    for shard in range(4):
+        for event in db.lrange(redis_keys.get_webhook_queue_key(shard), 0, -1):
+            event = json.loads(event)
+            queued_steps.setdefault(event['sender_id'], []).append(event['message'])
+    assert queued_steps == {
+        f'sender{sender_number}': [f'step,{event_number}' for event_number in range(EVENTS_PER_SENDER)]
+        for sender_number in range(SENDERS_COUNT)
+    }
+
+
+def test_telegram_updates_are_queued(client, db, moltin_server, telegram_server, telegram_updater, monkeypatch):
+    monkeypatch.setenv('ASYNC_WEBHOOK', 'true')
+    monkeypatch.setattr(tg_pizza_bot, '_database', db)
+    catalog.get_catalog(db, get_token(db))
+
+    update_ids = []
+    for update_number in range(3):
+        update_content = get_telegram_update(CHAT_ID, text='/start')
+        update_content['update_id'] = update_number + 1
+        update_ids.append(update_content['update_id'])
+        response = client.post(f'/telegram/{TELEGRAM_TOKEN}', data=json.dumps(update_content),
+                               content_type='application/json')
+        assert response.status_code == 200
+    assert telegram_server.requests_count == 0
+
+    queue_key = webhook_worker.get_queue_key(f'tg_{CHAT_ID}')
+    events = [json.loads(event) for event in db.lrange(queue_key, 0, -1)]
+    assert [event['update']['update_id'] for event in events] == update_ids
+
+    for event in events:
+        app.handle_event(event)
+    assert telegram_server.requests_count >= 3
+    assert session_store.load_session(db, CHAT_ID)['state'] == 'HANDLE_MENU'
+
+
+def test_telegram_updater_is_created_once(telegram_server, telegram_updater, monkeypatch):
+    threads_count = 8
+    created_updaters = []
+    create_updater = tg_pizza_bot.create_updater
+    barrier = Barrier(threads_count)
+
+    def create_slow_updater(token):
+        created_updaters.append(token)
+        time.sleep(0.05)
+        return create_updater(token)
+
+    def get_updater():
+        barrier.wait()
+        return app.get_telegram_updater()
+
+    monkeypatch.setattr(tg_pizza_bot, 'create_updater', create_slow_updater)
+    with ThreadPoolExecutor(threads_count) as executor:
+        updaters = list(executor.map(lambda __: get_updater(), range(threads_count)))
+
+    assert len(created_updaters) == 1
+    assert len(set(map(id, updaters))) == 1
+
+
+def test_redelivered_event_is_handled_once(client, db, monkeypatch):
+    handled_replies = []
+    monkeypatch.setattr(app, 'process_users_reply', lambda sender_id, reply: handled_replies.append(reply))
+    event = get_messenger_event('2001', message='menu')
+    echo = get_messenger_event('2001', message='menu')
+    echo['entry'][0]['messaging'][0]['message']['is_echo'] = True
+    read = {'object': 'page', 'entry': [{'id': 'page', 'messaging': [
+        {'sender': {'id': '2001'}, 'recipient': {'id': 'page'}, 'timestamp': 1, 'read': {'watermark': 1}}
+    ]}]}
+
+    for content in (event, event, echo, echo, read, read):
+        response = client.post('/', data=json.dumps(content), content_type='application/json')
+        assert response.status_code == 200
+
+    assert handled_replies == ['menu']
+    assert int(db.get(redis_keys.DUPLICATE_EVENTS_KEY)) == 1
+    assert len(db.keys('fb_event:*')) == 1
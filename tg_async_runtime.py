@@ -0,0 +1,78 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from telegram import Update
+from environs import Env
+
+env = Env()
+
+
+async def fetch_updates(session, api_url, offset, poll_timeout):
+    params = {'offset': offset, 'timeout': poll_timeout}
+    async with session.get(f'{api_url}/getUpdates', params=params) as response:
+        response.raise_for_status()
+        return (await response.json())['result']
+
+
+def get_chat_id(update):
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return None
+
+
+async def process_chat_updates(chat_id, chat_queues, dispatcher, executor):
+    loop = asyncio.get_event_loop()
+    queue = chat_queues[chat_id]
+    idle_timeout = env.int('TELEGRAM_CHAT_IDLE_TIMEOUT', 60)
+    while True:
+        try:
+            update = await asyncio.wait_for(queue.get(), idle_timeout)
+        except asyncio.TimeoutError:
+            if queue.empty():
+                del chat_queues[chat_id]
+                return
+            continue
+        try:
+            await loop.run_in_executor(executor, dispatcher.process_update, update)
+        except Exception as err:
+            logging.exception(err)
+
+
+def dispatch_update(update, chat_queues, dispatcher, executor):
+    chat_id = get_chat_id(update)
+    if chat_id not in chat_queues:
+        chat_queues[chat_id] = asyncio.Queue()
+        asyncio.ensure_future(process_chat_updates(chat_id, chat_queues, dispatcher, executor))
+    chat_queues[chat_id].put_nowait(update)
+
+
+async def poll_updates(dispatcher):
+    api_url = f'{env("TELEGRAM_API_URL", "https://api.telegram.org")}/bot{dispatcher.bot.token}'
+    poll_timeout = env.int('TELEGRAM_POLL_TIMEOUT', 30)
+    executor = ThreadPoolExecutor(max_workers=env.int('TELEGRAM_CONCURRENCY', 32))
+    chat_queues = {}
+    offset = 0
+
+    session_timeout = aiohttp.ClientTimeout(total=poll_timeout + 10)
+    async with aiohttp.ClientSession(timeout=session_timeout) as session:
+        while True:
+            try:
+                updates = await fetch_updates(session, api_url, offset, poll_timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                logging.warning('Telegram polling failed: %s', err)
+                await asyncio.sleep(1)
+                continue
+
+            for update_content in updates:
+                offset = update_content['update_id'] + 1
+                update = Update.de_json(update_content, dispatcher.bot)
+                dispatch_update(update, chat_queues, dispatcher, executor)
+
+
+def run_polling(dispatcher):
+    dispatcher.bot.delete_webhook()
+    asyncio.get_event_loop().run_until_complete(poll_updates(dispatcher))
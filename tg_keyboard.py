@@ -1,53 +1,67 @@
 from textwrap import dedent
-import json
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from more_itertools import chunked
+from more_itertools import chunked, peekable
 
 import moltin
 import closest_pizzeria
+import catalog
+import cart_mirror
 
+_menu_pages = (None, [])
 
-def get_menu_keyboard(chat_id, products, menu_button):
-    products_menu_pages = list(chunked(products, 6))
-    max_page_index = len(products_menu_pages)
 
-    if menu_button == '/start' or menu_button == 'menu':
-        page_number = 1
-    else:
-        __, page_number = menu_button.split(',')
-        page_number = int(page_number)
+def render_menu_pages(products):
+    products_menu_pages = peekable(chunked(products, 6))
 
-    products_keyboard = [
-            [InlineKeyboardButton(product['name'], callback_data=product['id'])] 
-            for product 
-            in products_menu_pages[page_number - 1]
-        ]
+    menu_pages = []
+    for page_number, page_products in enumerate(products_menu_pages, start=1):
+        products_keyboard = [
+                [InlineKeyboardButton(product['name'], callback_data=product['id'])] 
+                for product 
+                in page_products
+            ]
+
+        navigation_buttons = []
+        if page_number > 1:
+            navigation_buttons.append(
+                InlineKeyboardButton(f'<- стр {page_number - 1}', callback_data=f'prev,{page_number - 1}'))
+        if products_menu_pages:
+            navigation_buttons.append(
+                InlineKeyboardButton(f'стр {page_number + 1} ->', callback_data=f'next,{page_number + 1}'))
+        if navigation_buttons:
+            products_keyboard.append(navigation_buttons)
+
+        products_keyboard.append([InlineKeyboardButton('Корзина', callback_data='cart')])
+        menu_pages.append(InlineKeyboardMarkup(products_keyboard))
 
-    if page_number == 1:
-        products_keyboard.append([
-            InlineKeyboardButton(f'стр {page_number + 1} ->', callback_data=f'next,{page_number + 1}')
-            ])
+    return menu_pages
 
-    elif page_number == max_page_index:
-        products_keyboard.append([
-            InlineKeyboardButton(f'<- стр {page_number - 1}', callback_data=f'prev,{page_number - 1}')
-            ])
 
+def get_menu_keyboard(db, token, menu_button):
+    global _menu_pages
+    menu_catalog = catalog.get_catalog(db, token)
+    version, menu_pages = _menu_pages
+    if version != menu_catalog['version']:
+        menu_pages = render_menu_pages(menu_catalog['products'])
+        _menu_pages = (menu_catalog['version'], menu_pages)
+
+    if menu_button == '/start' or menu_button == 'menu':
+        page_number = 1
     else:
-        products_keyboard.append([
-            InlineKeyboardButton(f'<- стр {page_number - 1}', callback_data=f'prev,{page_number - 1}'), 
-            InlineKeyboardButton(f'стр {page_number + 1} ->', callback_data=f'prev,{page_number + 1}')
-            ])
-    
-    products_keyboard.append([InlineKeyboardButton('Корзина', callback_data='cart')])
-    return InlineKeyboardMarkup(products_keyboard)
+        __, __, page_number = menu_button.partition(',')
+        if not page_number.isdigit():
+            return None
+        page_number = int(page_number)
+
+    if not 1 <= page_number <= len(menu_pages):
+        return None
+    return menu_pages[page_number - 1]
 
 
 def get_product_reply(db, product_id, token):
-    products = json.loads(db.get('products'))
-    product = next((product for product in products if product['id'] == product_id))
-    image = moltin.get_image_url(token, product['image_id'])
+    product = catalog.get_product(db, token, product_id)
+    image = product['image_url']
 
     product_keyboard = [
         [InlineKeyboardButton(f'Выбрать - {product["name"]}', callback_data=f'{product_id}')],
@@ -63,8 +77,8 @@ def get_product_reply(db, product_id, token):
     return reply_markup, message, image
 
 
-def get_cart_reply(token, chat_id):
-    cart = moltin.get_cart_items(token, chat_id)
+def get_cart_reply(db, token, chat_id):
+    cart = cart_mirror.get_cart(db, token, chat_id)
     message = ''
     keyboard = []
     for product in cart['items']:
@@ -90,9 +104,14 @@ def get_cart_reply(token, chat_id):
     return reply_markup, message, cart
 
 
-def get_location_reply(token, lon, lat):
-    pizzerias = moltin.get_all_pizzerias(token)
-    pizzeria = closest_pizzeria.get_closest_pizzeria(lon, lat, pizzerias)
+def get_location_reply(db, token, lon, lat):
+    pizzerias_index = catalog.get_pizzerias_index(db, token)
+    pizzeria = closest_pizzeria.get_closest_pizzeria(lon, lat, pizzerias_index)
+    if pizzeria is None:
+        message = 'К сожалению, сейчас нет ни одной открытой пиццерии'
+        keyboard = [[InlineKeyboardButton('Изменить заказ', callback_data='cart')]]
+        return InlineKeyboardMarkup(keyboard), message, None, -1
+
     pizzeria['customer_lon'] = lon
     pizzeria['customer_lat'] = lat
 
@@ -140,10 +159,12 @@ def get_location_reply(token, lon, lat):
     return reply_markup, message, pizzeria, delivery_fee
 
 
-def get_delivery_reply(token, query, pizzeria, cart):
+def get_delivery_reply(db, token, query, pizzeria, cart):
     chat_id = query.message.chat_id
 
     moltin.fill_customer_fields(chat_id, pizzeria['customer_lat'], pizzeria['customer_lon'], token)
+    synced_cart = cart_mirror.sync_cart(db, token, chat_id)
+    cart['items'], cart['total_amount'] = synced_cart['items'], synced_cart['total_amount']
 
     message = 'Спасибо за выбор нашей пиццы!\n'
     if query.data == 'self':
@@ -1,31 +1,39 @@
 import logging
+from functools import partial
 from textwrap import dedent
-import json
 
-import redis
+import requests
 from telegram.ext import Updater
 from telegram.ext import CallbackQueryHandler, CommandHandler, MessageHandler
 from telegram.ext import Filters, PreCheckoutQueryHandler
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.utils.request import Request
 from environs import Env
 
 from moltin_token import get_token
 from fetch_coordinates import fetch_coordinates
 import moltin
+import catalog
+import cart_mirror
+import cart_debounce
 import tg_keyboard
+import session_store
+import user_lock
+import profiling
+import tg_async_runtime
 import payment
 
 env = Env()
 env.read_env()
 
-yandex_apikey = env('YANDEX_MAP_KEY')
-
 _database = None
-moltin_token = None
-moltin_token_time = 0
+
+UNAVAILABLE_MESSAGE = 'Магазин временно недоступен, попробуйте, пожалуйста, через пару минут'
+CART_UNAVAILABLE_MESSAGE = 'Не получилось изменить корзину: магазин временно недоступен, попробуйте, пожалуйста, через пару минут'
+BUSY_MESSAGE = 'Ещё готовим ответ на ваше прошлое сообщение, повторите, пожалуйста, через минуту'
 
 
-def start(update, context, db, token):
+def start(update, context, db, token, session):
     query = update.callback_query
     if query:
         chat_id = query.message.chat_id
@@ -34,9 +42,7 @@ def start(update, context, db, token):
         menu_button = update.message.text
         chat_id = update.message.chat_id
     
-    products = moltin.get_products_list(token)
-    db.set('products', json.dumps(products))
-    reply_markup = tg_keyboard.get_menu_keyboard(chat_id, products, menu_button)
+    reply_markup = tg_keyboard.get_menu_keyboard(db, token, menu_button)
 
     if reply_markup is None:
         message = 'Для того, чтобы начать отправьте боту /start'
@@ -52,7 +58,7 @@ def start(update, context, db, token):
     return 'HANDLE_MENU'
 
 
-def handle_menu(update, context, db, token):
+def handle_menu(update, context, db, token, session):
     query = update.callback_query
     chat_id = query.message.chat_id
 
@@ -66,57 +72,67 @@ def handle_menu(update, context, db, token):
     return 'HANDLE_DESCRIPTION'
 
 
-def handle_description(update, context, db, token):
+def handle_description(update, context, db, token, session):
     query = update.callback_query
     chat_id = query.message.chat_id
     product_id = query.data
-    products = json.loads(db.get('products'))
-    
-    product = next((product for product in products if product['id'] == product_id))
-    moltin.add_product_to_cart(token=token,
-                               product_id=product['id'],
-                               quantity=1,
-                               chat_id=chat_id)
-    message = f'{product["name"]} добавлена в корзину'
+    product = catalog.get_product(db, token, product_id)
+    cart_debounce.add_product(db, token, 'telegram', f'tg_{chat_id}', chat_id, product['id'], quantity=1)
+    if cart_debounce.is_enabled():
+        message = f'Добавляем {product["name"]} в корзину'
+    else:
+        message = f'{product["name"]} добавлена в корзину'
     context.bot.answer_callback_query(callback_query_id=query.id, text=message)
 
     return 'HANDLE_DESCRIPTION'
 
 
-def handle_cart(update, context, db, token):
+def handle_cart(update, context, db, token, session):
     query = update.callback_query
     chat_id = query.message.chat_id
-    user_cart = f'{chat_id}_cart'
 
     if 'remove' in query.data:
-        product_id = query.data.split(',')[1]
-        moltin.remove_cart_item(token=token,
-                                 product_id=product_id,
-                                 chat_id=chat_id)
-
-    reply_markup, message, cart = tg_keyboard.get_cart_reply(moltin_token, chat_id)
-    db.set(user_cart, json.dumps(cart))
+        item_id = query.data.split(',')[1]
+        reply = {'message_id': query.message.message_id}
+        cart_debounce.remove_item(db, token, 'telegram', f'tg_{chat_id}', chat_id, item_id, reply)
+        if cart_debounce.is_enabled():
+            # The cart message is edited once the removal is applied
+            context.bot.answer_callback_query(callback_query_id=query.id, text='Убираем из корзины')
+            return 'HANDLE_CART'
+
+    reply_markup, message, cart = tg_keyboard.get_cart_reply(db, token, chat_id)
+    session['cart'] = cart
     query.edit_message_text(text=message, reply_markup=reply_markup)
 
     return 'HANDLE_CART'
 
 
-def handle_waiting(update, context, db, token):
+def send_cart_changes(bot, db, token, user, cart_id, cart, changes):
+    if cart is None:
+        bot.send_message(chat_id=cart_id, text=CART_UNAVAILABLE_MESSAGE)
+        return
+    message_ids = [change['reply']['message_id'] for change in changes if change['reply'].get('message_id')]
+    if message_ids:
+        reply_markup, message, __ = tg_keyboard.get_cart_reply(db, token, cart_id)
+        bot.edit_message_text(chat_id=cart_id, message_id=message_ids[-1], text=message, reply_markup=reply_markup)
+
+
+def handle_waiting(update, context, db, token, session):
     query = update.callback_query
     query.edit_message_text('Пожалуйста, напишите адрес текстом или пришлите локацию')
 
     return 'HANDLE_LOCATION'
 
 
-def handle_location(update, context, db, token):
+def handle_location(update, context, db, token, session):
     chat_id = update.message.chat_id
-    user_cart = f'{chat_id}_cart'
-    user_pizzeria = f'{chat_id}_pizzeria'
 
     if update.message.text:
         try:
-            lon, lat = fetch_coordinates(update.message.text, yandex_apikey)
-        except IndexError:
+            lon, lat = fetch_coordinates(update.message.text, env('YANDEX_MAP_KEY'), db)
+        except (IndexError, requests.RequestException) as err:
+            # A slow or failed geocoder is answered like an address it has not found
+            logging.warning('Address of chat %s is not found: %s', chat_id, err)
             context.bot.send_message(chat_id=chat_id,
                                      text='К сожалению не удалось определить локацию. Попробуйте еще раз')
             return 'HANDLE_LOCATION'
@@ -125,39 +141,33 @@ def handle_location(update, context, db, token):
         lat = update.message.location.latitude
         lon = update.message.location.longitude
 
-    reply_markup, message, pizzeria, delivery_fee = tg_keyboard.get_location_reply(token, lon, lat)
+    reply_markup, message, pizzeria, delivery_fee = tg_keyboard.get_location_reply(db, token, lon, lat)
     update.message.reply_text(message, reply_markup=reply_markup)
 
-    cart = json.loads(db.get(user_cart))
-    cart['delivery_fee'] = delivery_fee
-    db.set(user_cart, json.dumps(cart))
-    db.set(user_pizzeria, json.dumps(pizzeria))
+    session['cart']['delivery_fee'] = delivery_fee
+    session['pizzeria'] = pizzeria
 
     return 'HANDLE_DELIVERY'
 
 
-def handle_delivery(update, context, db, token):
+def handle_delivery(update, context, db, token, session):
     query = update.callback_query
-    chat_id = query.message.chat_id
-    user_cart = f'{chat_id}_cart'
-    user_pizzeria = f'{chat_id}_pizzeria'
 
-    cart = json.loads(db.get(user_cart))
-    pizzeria = json.loads(db.get(user_pizzeria))
+    cart = session['cart']
+    pizzeria = session['pizzeria']
 
-    reply_markup, customer_message, cart = tg_keyboard.get_delivery_reply(token, query, pizzeria, cart)
+    reply_markup, customer_message, cart = tg_keyboard.get_delivery_reply(db, token, query, pizzeria, cart)
     query.edit_message_text(customer_message, reply_markup=reply_markup)
-    db.set(user_cart, json.dumps(cart))
+    session['cart'] = cart
 
     return 'HANDLE_PAYMENT'
 
 
-def handle_payment(update, context, db, token):
+def handle_payment(update, context, db, token, session):
     query = update.callback_query
     chat_id = query.message.chat_id
 
-    user_cart = f'{chat_id}_cart'
-    cart = json.loads(db.get(user_cart))
+    cart = session['cart']
     if query.data == 'cash':
         keyboard = [[InlineKeyboardButton(f'Подтверждаю', callback_data='cash_confirm')]]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -184,12 +194,8 @@ def handle_payment(update, context, db, token):
             return 'FINISH'
 
 
-def handle_deliveryman(update, context, db, token):
+def handle_deliveryman(update, context, db, token, session):
     query = update.callback_query
-    chat_id = query.message.chat_id
-
-    user_cart = f'{chat_id}_cart'
-    user_pizzeria = f'{chat_id}_pizzeria'
 
     message = dedent(f'''
             Cпасибо за выбор нашей пиццы!
@@ -197,8 +203,8 @@ def handle_deliveryman(update, context, db, token):
             ''')
     query.edit_message_text(message)
 
-    pizzeria = json.loads(db.get(user_pizzeria))
-    cart = json.loads(db.get(user_cart))
+    pizzeria = session['pizzeria']
+    cart = session['cart']
 
     context.bot.send_message(chat_id=pizzeria['deliveryman-chat-id'], text=cart['delivery_message'])
     context.bot.send_location(chat_id=pizzeria['deliveryman-chat-id'],
@@ -210,7 +216,7 @@ def handle_deliveryman(update, context, db, token):
     return 'HANDLE_DELIVERYMAN'
 
 
-def finish(update, context, db, token):
+def finish(update, context, db, token, session):
     query = update.callback_query
 
     if query:
@@ -219,11 +225,9 @@ def finish(update, context, db, token):
             query.edit_message_text('Очень жаль, что не удалось Вам помочь')
     else:
         chat_id = update.message.chat_id
-    user_cart = f'{chat_id}_cart'
-    user_pizzeria = f'{chat_id}_pizzeria'
 
-    cart = json.loads(db.get(user_cart))
-    pizzeria = json.loads(db.get(user_pizzeria))
+    cart = session['cart']
+    pizzeria = session['pizzeria']
     if not cart['delivery']:
         message = dedent(f'''
            Cпасибо за выбор нашей пиццы!\n
@@ -241,7 +245,7 @@ def finish(update, context, db, token):
                                   latitude=pizzeria['latitude'],
                                   longitude=pizzeria['longitude'])
 
-    moltin.remove_all_cart_items(token, chat_id)
+    cart_mirror.clear_cart(db, token, chat_id)
     return 'START'
 
 
@@ -254,14 +258,13 @@ def send_delivery_notification(context):
     context.bot.send_message(job.context, text=message)
 
 
+@profiling.profiled_turn('telegram')
 def handle_users_reply(update, context):
-    global moltin_token
-    global moltin_token_time
     query = update.callback_query
     db = get_database_connection()
 
     if update.message:
-        user_reply = update.message.text
+        user_reply = update.message.text or ''
         chat_id = update.message.chat_id
     elif query:
         user_reply = query.data
@@ -269,19 +272,15 @@ def handle_users_reply(update, context):
     else:
         return
 
-    if user_reply == '/start' or user_reply == 'menu':
-        user_state = 'START'
-    elif 'prev' in user_reply or 'next' in user_reply:
-        user_state = 'START'
-    elif user_reply == 'cart':
-        user_state = 'HANDLE_CART'
-    elif user_reply == 'delivery_choice':
-        user_state = 'HANDLE_WAITING'
-    elif user_reply == 'close':
-        user_state = 'FINISH'
-    else:
-        user_state = db.get(chat_id).decode("utf-8")
+    try:
+        with user_lock.hold_lock(db, f'tg_{chat_id}'):
+            reply_to_user(update, context, db, chat_id, user_reply)
+    except user_lock.UserBusy as err:
+        logging.warning('Reply to %s is not handled: %s', chat_id, err)
+        context.bot.send_message(chat_id=chat_id, text=BUSY_MESSAGE)
+
 
+def reply_to_user(update, context, db, chat_id, user_reply):
     states_functions = {
         'START': start,
         'HANDLE_MENU': handle_menu,
@@ -294,11 +293,36 @@ def handle_users_reply(update, context):
         'HANDLE_DELIVERYMAN': handle_deliveryman,
         'FINISH': finish,
     }
-    moltin_token, moltin_token_time = get_token(moltin_token, moltin_token_time)
+    session = session_store.load_session(db, chat_id)
+
+    if user_reply == '/start' or user_reply == 'menu':
+        user_state = 'START'
+    elif user_reply.startswith('prev,') or user_reply.startswith('next,'):
+        user_state = 'START'
+    elif user_reply == 'cart':
+        user_state = 'HANDLE_CART'
+    elif user_reply == 'delivery_choice':
+        user_state = 'HANDLE_WAITING'
+    elif user_reply == 'close':
+        user_state = 'FINISH'
+    else:
+        user_state = session.get('state')
+
+    if user_state not in states_functions:
+        user_state = 'START'
+
+    profiling.set_turn_state(user_state)
     state_handler = states_functions[user_state]
     try:
-        next_state = state_handler(update, context, db, moltin_token)
-        db.set(chat_id, next_state)
+        moltin_token = get_token(db)
+        next_state = state_handler(update, context, db, moltin_token, session)
+        # A handler that does not know the reply keeps the user where they are
+        if next_state in states_functions:
+            session['state'] = next_state
+        session_store.save_session(db, chat_id, session)
+    except moltin.MoltinUnavailable as err:
+        logging.warning('Reply to %s is not handled: %s', chat_id, err)
+        context.bot.send_message(chat_id=chat_id, text=UNAVAILABLE_MESSAGE)
     except Exception as err:
         logging.exception(err)
 
@@ -310,18 +334,24 @@ def get_database_connection():
         database_host = env("DATABASE_HOST")
         database_port = env("DATABASE_PORT")
 
-        _database = redis.Redis(host=database_host,
-                                port=database_port,
-                                password=database_password)
+        _database = profiling.InstrumentedRedis(host=database_host,
+                                                port=database_port,
+                                                password=database_password)
     return _database
 
 
-if __name__ == '__main__':
-    token = env("TELEGRAM_TOKEN")
-    logging.basicConfig(format="%(process)d %(levelname)s %(message)s",
-                        level=logging.WARNING)
+class TimedRequest(Request):
+    def _request_wrapper(self, *args, **kwargs):
+        method, url = args[:2]
+        with profiling.timed('telegram', f'{method} {url.rsplit("/", 1)[-1]}'):
+            return super()._request_wrapper(*args, **kwargs)
+
 
-    updater = Updater(token, use_context=True)
+def create_updater(token):
+    base_url = f'{env("TELEGRAM_API_URL", "https://api.telegram.org")}/bot'
+    request = TimedRequest(con_pool_size=env.int('TELEGRAM_CONCURRENCY', 32) + 4)
+    bot = Bot(token, base_url=base_url, request=request)
+    updater = Updater(bot=bot, use_context=True)
     dispatcher = updater.dispatcher
 
     dispatcher.add_handler(CallbackQueryHandler(handle_users_reply, pass_job_queue=True))
@@ -331,4 +361,25 @@ if __name__ == '__main__':
     dispatcher.add_handler(MessageHandler(Filters.successful_payment, payment.successful_payment_callback))
     dispatcher.add_handler(CommandHandler('start', handle_users_reply))
 
-    updater.start_polling()
+    return updater
+
+
+if __name__ == '__main__':
+    token = env("TELEGRAM_TOKEN")
+    logging.basicConfig(format="%(process)d %(levelname)s %(message)s",
+                        level=logging.WARNING)
+
+    db = get_database_connection()
+    catalog.start_catalog_refresher(db, lambda: get_token(db))
+
+    updater = create_updater(token)
+    cart_debounce.start_flusher(db, lambda: get_token(db), 'telegram', partial(send_cart_changes, updater.bot))
+
+    telegram_mode = env('TELEGRAM_MODE', 'polling')
+    if telegram_mode == 'webhook':
+        updater.bot.set_webhook(f'{env("TELEGRAM_WEBHOOK_URL")}/telegram/{token}')
+    elif telegram_mode == 'asyncio':
+        updater.job_queue.start()
+        tg_async_runtime.run_polling(updater.dispatcher)
+    else:
+        updater.start_polling()
@@ -0,0 +1,51 @@
+import logging
+from contextlib import contextmanager
+from threading import Event, Thread
+
+from environs import Env
+from redis.exceptions import LockError
+
+import redis_keys
+
+env = Env()
+
+
+class UserBusy(Exception):
+    pass
+
+
+def keep_lock(lock, user, interval, released):
+    # The lock expires only when its process is gone, not when a turn is slow
+    while not released.wait(interval):
+        try:
+            lock.reacquire()
+        except LockError:
+            logging.warning('Lock of %s has expired before the reply was handled', user)
+            return
+
+
+@contextmanager
+def hold_lock(db, user, wait=None):
+    # The lock lets one reply of a user run at a time, it does not keep the order
+    # in which they arrived: the worker queues of webhook_worker.py do that
+    lock_timeout = env.int('USER_LOCK_TIMEOUT', 30)
+    if wait is None:
+        wait = lock_timeout
+    # Not thread local, the keeper thread extends it with the token of the turn
+    lock = db.lock(redis_keys.get_lock_key(user), timeout=lock_timeout,
+                   blocking_timeout=wait, thread_local=False)
+    if not lock.acquire():
+        raise UserBusy(f'Previous reply of {user} is still handled')
+
+    released = Event()
+    keeper = Thread(target=keep_lock, args=(lock, user, lock_timeout / 3, released), daemon=True)
+    keeper.start()
+    try:
+        yield
+    finally:
+        released.set()
+        keeper.join()
+        try:
+            lock.release()
+        except LockError:
+            logging.warning('Lock of %s has expired before the reply was handled', user)
@@ -0,0 +1,62 @@
+import logging
+import json
+import zlib
+from threading import Thread
+
+from environs import Env
+
+import redis_keys
+import user_lock
+
+env = Env()
+
+
+def get_queue_key(sender_id):
+    shards_count = env.int('WEBHOOK_QUEUE_SHARDS', 8)
+    shard = zlib.crc32(str(sender_id).encode('utf-8')) % shards_count
+    return redis_keys.get_webhook_queue_key(shard)
+
+
+def enqueue_event(db, sender_id, message):
+    event = json.dumps({'channel': 'messenger', 'sender_id': sender_id, 'message': message})
+    db.rpush(get_queue_key(sender_id), event)
+
+
+def enqueue_telegram_update(db, chat_id, update_content):
+    event = json.dumps({'channel': 'telegram', 'update': update_content})
+    db.rpush(get_queue_key(f'tg_{chat_id}'), event)
+
+
+def drain_queue(db, queue_key, handle_event):
+    while True:
+        __, raw_event = db.blpop(queue_key)
+        event = json.loads(raw_event)
+        try:
+            handle_event(event)
+        except user_lock.UserBusy as err:
+            # Back to the head of the queue, so the next events of the user wait for it
+            logging.warning('Event is queued again: %s', err)
+            db.lpush(queue_key, raw_event)
+        except Exception as err:
+            logging.exception(err)
+
+
+def run_workers(db, handle_event):
+    shards_count = env.int('WEBHOOK_QUEUE_SHARDS', 8)
+    workers = [
+        Thread(target=drain_queue, args=(db, redis_keys.get_webhook_queue_key(shard), handle_event), daemon=True)
+        for shard in range(shards_count)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == '__main__':
+    import app
+
+    env.read_env()
+    logging.basicConfig(format="%(process)d %(levelname)s %(message)s",
+                        level=logging.WARNING)
+    run_workers(app.get_database_connection(), app.handle_event)